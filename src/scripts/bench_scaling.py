@@ -0,0 +1,275 @@
+"""
+bench_scaling.py
+================
+Measures how the pipeline scales, on synthetic datasets (see `synthetic_xp.py`) of
+10^4-10^6 sources, so no real data or network access is needed.
+At each size, in a fresh process run from the dataset's `scripts/` directory (so
+that every `../data/...` path resolves to the synthetic data, and no caches carry
+over), the steps are:
+- reading the XP table (`process_xp.read_xp_to_arrays`)
+- building the GF+21 catalogue and normalising by G flux (`divide_Gflux`)
+- building the label table, and `is_polluted` over every ID, one at a time and
+  vectorised (`is_polluted_many`)
+- tSNE and UMAP (`umap_tsne_xp.dim_reduce`, as in its `__main__`), and the DBSCAN
+  isolation of the polluted islands from the tSNE (`tsne_clustering`), up to
+  `EMBEDDING_MAX_SIZE` sources
+Each step's wall time, CPU time and memory (the increase in peak RSS) are recorded
+(see `profiling.py`), and the results saved, with the git commit, to
+`data/interim/benchmarks/scaling_{commit}_{time}.json`, so that runs can be
+compared across commits (`compare_reports`, `plot_scaling`).
+"""
+
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import profiling as pr
+import synthetic_xp as sx
+
+SIZES = [10_000, 30_000, 100_000, 300_000, 1_000_000]
+EMBEDDING_MAX_SIZE = 100_000  # tSNE/UMAP get slow beyond this
+RESULTS_DIR = "../data/interim/benchmarks"
+STEPS = [
+    "read_xp",
+    "build_catalogue",
+    "divide_Gflux",
+    "build_label_table",
+    "is_polluted",
+    "is_polluted_many",
+    "tsne",
+    "umap",
+    "isolate_islands",
+]
+METRICS = ["wall_time", "cpu_time", "peak_rss", "memory"]
+
+
+def git_commit():
+    "The current git commit (short hash), marked '+' if the tree has changes"
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+        is_dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return "unknown"
+    return (commit or "unknown") + ("+" if is_dirty else "")
+
+
+def clear_derived(scripts_dir):
+    "Removes everything derived from a synthetic dataset's inputs (caches, outputs)"
+    data_dir = os.path.join(scripts_dir, "..", "data")
+    for sub in ["interim", "processed"]:
+        for name in os.listdir(os.path.join(data_dir, sub)):
+            if name == "gf21_filtered.csv":
+                continue
+            path = os.path.join(data_dir, sub, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def warm_up(n_sources=500):
+    """
+    Runs tSNE and UMAP on a few random sources, so that numba's JIT compilation
+     isn't counted in the first benchmark
+    """
+    import umap_tsne_xp as ut
+
+    data = np.random.default_rng(0).normal(size=(n_sources, 2 * sx.N_COEFFS))
+    ut.dim_reduce(data, "tsne", knn_backend=ut.KNN_BACKEND, perplexity=50)
+    ut.dim_reduce(data, "umap", knn_backend=ut.KNN_BACKEND, n_neighbors=25)
+
+
+def run_steps(scripts_dir, n_sources, embedding_max_size=EMBEDDING_MAX_SIZE):
+    """
+    Runs the benchmark steps on the synthetic dataset of `n_sources` whose
+     `scripts/` directory is `scripts_dir`, in this (fresh, worker) process.
+    Returns the profiling records of the steps (and the stages within them).
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(scripts_dir)
+    is_embedded = n_sources <= embedding_max_size
+    if is_embedded:
+        warm_up()
+    pr.ENABLED = True
+    pr.RECORDS.clear()
+
+    import check_polluted as cp
+    import gf21_catalogue as gf
+    import preprocessors as pp
+    import process_xp as px
+    import tsne_clustering as tc
+    import umap_tsne_xp as ut
+
+    with pr.stage("read_xp"):
+        ids, xp, _ = px.read_xp_to_arrays("../data/external/xp.csv", px.CHUNKSIZE)
+    with pr.stage("build_catalogue", rows=len(ids)):
+        gf.load_catalogue()
+    with pr.stage("divide_Gflux", rows=len(ids)):
+        pxp = pp.divide_Gflux(xp, ids)
+    with pr.stage("build_label_table"):
+        cp.load_label_table()
+    with pr.stage("is_polluted", rows=len(ids)):
+        [cp.is_polluted(id_) for id_ in ids]
+    with pr.stage("is_polluted_many", rows=len(ids)):
+        cp.is_polluted_many(ids)
+
+    if is_embedded:
+        with pr.stage("tsne", rows=len(ids)):
+            embedding = ut.dim_reduce(
+                pxp, "tsne", knn_backend=ut.KNN_BACKEND, perplexity=50
+            )
+        np.savez_compressed(tc.EMBEDDING_FILE, ids=ids, embedding=embedding)
+        with pr.stage("umap", rows=len(ids)):
+            ut.dim_reduce(
+                pxp, "umap", knn_backend=ut.KNN_BACKEND, n_neighbors=25, min_dist=0.05
+            )
+        with pr.stage("isolate_islands", rows=len(ids)):
+            tc.load_clustering()
+
+    records = [r for r in pr.RECORDS if "wall_time" in r]
+    pr.RECORDS.clear()  # Reported here, not in a profile of the worker
+    return records
+
+
+def bench_scaling(
+    sizes=SIZES, seed=0, embedding_max_size=EMBEDDING_MAX_SIZE, out_dir=RESULTS_DIR
+):
+    """
+    Runs the benchmark steps (see `run_steps`) at each of `sizes`, generating the
+     synthetic datasets first if needed, and saves the results to `out_dir`.
+    Returns the path of the results.
+    """
+    results = {}
+    for n_sources in sizes:
+        scripts_dir = os.path.abspath(sx.write_dataset(n_sources, seed))
+        clear_derived(scripts_dir)
+        print(f"Benchmarking {n_sources} sources...")
+        with ProcessPoolExecutor(max_workers=1) as pool:  # Fresh caches and memory
+            records = pool.submit(
+                run_steps, scripts_dir, n_sources, embedding_max_size
+            ).result()
+        results[n_sources] = records
+        print(pr.summarise(records))
+
+    commit = git_commit()
+    timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    path = os.path.join(out_dir, f"scaling_{commit}_{timestamp}.json")
+    os.makedirs(out_dir, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "commit": commit,
+                "timestamp": timestamp,
+                "seed": seed,
+                "cpu_count": os.cpu_count(),
+                "results": {str(n): records for n, records in results.items()},
+            },
+            f,
+            indent=1,
+        )
+    print(f"Saved to {path}")
+    return path
+
+
+# --------------------------
+# Scaling curves
+
+
+def scaling_curves(path):
+    """
+    Loads the results in `path` as scaling curves of the top-level steps.
+    Returns a dict of step -> {"size": ..., "wall_time": ..., "cpu_time": ...,
+     "peak_rss": ..., "memory": ...} arrays, ordered by size, where `memory` is the
+     peak RSS above the RSS at the start of the step (i.e. the memory it used).
+    """
+    with open(path) as f:
+        report = json.load(f)
+    curves = {}
+    for size, records in sorted(report["results"].items(), key=lambda x: int(x[0])):
+        for r in records:
+            if r["depth"] > 0:
+                continue
+            curve = curves.setdefault(r["name"], {k: [] for k in ["size"] + METRICS})
+            curve["size"].append(int(size))
+            r = {**r, "memory": r["peak_rss"] - r["start_rss"]}
+            for metric in METRICS:
+                curve[metric].append(r[metric])
+    return {
+        name: {k: np.array(v) for k, v in curve.items()}
+        for name, curve in curves.items()
+    }
+
+
+def scaling_exponent(curve, metric="wall_time"):
+    "The power-law slope of `metric` against size, from a log-log fit"
+    if len(curve["size"]) < 2:
+        return np.nan
+    return np.polyfit(np.log(curve["size"]), np.log(curve[metric]), 1)[0]
+
+
+def compare_reports(old_path, new_path):
+    """
+    Prints the ratio of wall time and memory (new / old) of each step at each size
+     the two results have in common, and their scaling exponents
+    """
+    old, new = scaling_curves(old_path), scaling_curves(new_path)
+    print(f"{'step':<18} {'size':>9} {'time ratio':>11} {'memory ratio':>13}")
+    for name in [s for s in STEPS if s in old and s in new]:
+        for i, size in enumerate(new[name]["size"]):
+            j = np.flatnonzero(old[name]["size"] == size)
+            if len(j) == 0:
+                continue
+            time_ratio = new[name]["wall_time"][i] / old[name]["wall_time"][j[0]]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rss_ratio = new[name]["memory"][i] / old[name]["memory"][j[0]]
+            print(f"{name:<18} {size:>9} {time_ratio:>11.2f} {rss_ratio:>13.2f}")
+        print(
+            f"{name:<18} {'exponent':>9} {scaling_exponent(old[name]):>5.2f} ->"
+            f" {scaling_exponent(new[name]):.2f}"
+        )
+
+
+def plot_scaling(paths, out_file=None):
+    """
+    Plots the wall time and memory of each step against size (log-log), one line
+     per step, for each results file in `paths` (solid, dashed, ... in order)
+    """
+    import matplotlib.pyplot as plt
+
+    fig, axs = plt.subplots(1, 2, figsize=(10, 4))
+    linestyles = ["-", "--", ":", "-."]
+    for k, path in enumerate(paths):
+        curves = scaling_curves(path)
+        for i, name in enumerate([s for s in STEPS if s in curves]):
+            curve = curves[name]
+            style = dict(color=f"C{i}", ls=linestyles[k % len(linestyles)], marker=".")
+            label = name if k == 0 else None
+            axs[0].plot(curve["size"], curve["wall_time"], label=label, **style)
+            axs[1].plot(curve["size"], curve["memory"] / 2**20, **style)
+    for ax, ylabel in zip(axs, ["Wall time (s)", "Memory (peak RSS increase, MB)"]):
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_xlabel("Number of sources")
+        ax.set_ylabel(ylabel)
+    axs[0].legend(fontsize="small")
+    fig.tight_layout()
+    if out_file is not None:
+        fig.savefig(out_file, dpi=150)
+    return fig
+
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or SIZES
+    bench_scaling(sizes)
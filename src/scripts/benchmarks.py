@@ -0,0 +1,144 @@
+"""
+benchmarks.py
+=============
+Benchmarks of the slow parts of the pipeline, comparing new implementations
+against the ones they replaced.
+"""
+
+import time
+from ast import literal_eval
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import NearestNeighbors
+
+import check_polluted as cp
+import preprocessors as pp
+import process_xp as px
+import umap_tsne_xp as ut
+import xp_store as xs
+
+XP_FILE = "../data/external/xp.csv"
+XP_COEFFS_STORE = "../data/interim/xp_coeffs"
+
+
+def timeit(func, *args, n_repeats=3, **kwargs):
+    """
+    Runs `func(*args, **kwargs)` `n_repeats` times.
+    Returns the best wall time (s) and the output of the last run.
+    """
+    best = np.inf
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        out = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def literal_eval_coefficients(column):
+    "The original per-row parser, kept as a baseline"
+    return np.array([literal_eval(coeffs) for coeffs in column])
+
+
+def bench_parse_coefficients(filename=XP_FILE, nrows=20_000):
+    """
+    Compares `literal_eval` against `process_xp.parse_coefficients`, on the four
+     coefficient columns of the first `nrows` rows of `filename`.
+    """
+    table = pd.read_csv(
+        filename, usecols=px.COEFF_COLUMNS + px.ERR_COLUMNS, nrows=nrows
+    )
+    print(f"Parsing {4 * len(table)} coefficient arrays:")
+    for name, parser in [
+        ("literal_eval", literal_eval_coefficients),
+        ("parse_coefficients", px.parse_coefficients),
+    ]:
+        t, out = timeit(
+            lambda: [parser(table[col]) for col in px.COEFF_COLUMNS + px.ERR_COLUMNS]
+        )
+        print(f"  {name:>20}: {t:.3f}s")
+
+    baseline = [
+        literal_eval_coefficients(table[col])
+        for col in px.COEFF_COLUMNS + px.ERR_COLUMNS
+    ]
+    assert all(np.array_equal(a, b) for a, b in zip(baseline, out)), "Mismatch!"
+
+
+def check_exact_ids():
+    """
+    Checks that Gaia IDs above 2**53 (where float64 can't represent every integer)
+     are kept exactly, by `check_polluted.as_gaia_ids` and in the MWDD index
+    """
+    big_id = 2**53 + 1  # 9007199254740993, which rounds to 2**53 as a float
+    assert cp.as_gaia_ids([str(big_id)])[0] == big_id, "Mismatch!"
+    assert cp.as_gaia_ids([f"Gaia DR3 {big_id}"])[0] == big_id, "Mismatch!"
+    assert cp.as_gaia_id(np.int64(big_id)) == big_id, "Mismatch!"
+    try:
+        cp.as_gaia_ids([float(big_id)])
+        raise AssertionError("Inexact float ID accepted")
+    except ValueError:
+        pass
+
+    raw = pd.read_csv(cp.SOURCE_FILES["mwdd"], usecols=["gaiaedr3"], dtype=str)
+    raw_ids = raw["gaiaedr3"].dropna().astype(np.int64)
+    assert set(cp.load_mwdd().index) <= set(raw_ids), "MWDD IDs changed on loading"
+    n_big = np.sum(raw_ids.values > 2**53)
+    print(f"Gaia IDs exact above 2**53 ({n_big} such IDs in MWDD)")
+
+
+def bench_is_polluted(ids=None):
+    """
+    Compares a loop over `check_polluted.is_polluted` against
+     `check_polluted.is_polluted_many`, on `ids` (default: the whole sample).
+    """
+    if ids is None:
+        ids = np.asarray(xs.load_store(XP_COEFFS_STORE)["ids"])
+    print(f"Labelling {len(ids)} IDs:")
+    t_loop, baseline = timeit(
+        lambda: np.array([cp.is_polluted(id_) for id_ in ids]), n_repeats=1
+    )
+    print(f"  {'is_polluted loop':>20}: {t_loop:.3f}s")
+    t_many, labels = timeit(cp.is_polluted_many, ids)
+    print(f"  {'is_polluted_many':>20}: {t_many:.3f}s")
+    assert np.array_equal(baseline, labels), "Mismatch!"
+
+
+def neighbourhood_preservation(data, embedding, k=10):
+    "Mean fraction of each point's `k` nearest neighbours in `data` kept in `embedding`"
+    neighbours = [
+        NearestNeighbors(n_neighbors=k + 1).fit(x).kneighbors(x)[1][:, 1:]
+        for x in (data, embedding)
+    ]
+    shared = (neighbours[0][:, :, None] == neighbours[1][:, None, :]).any(axis=2)
+    return shared.mean()
+
+
+def bench_tsne_engines(n_sources=50_000, perplexity=50):
+    """
+    Compares the tSNE engines of `umap_tsne_xp.dim_reduce` on the first `n_sources`
+     G-flux-normalised XP spectra, by time and neighbourhood preservation.
+    """
+    store = xs.load_store(XP_COEFFS_STORE)
+    ids = np.asarray(store["ids"][:n_sources])
+    data = pp.divide_Gflux(np.asarray(store["xp"][:n_sources]), ids)
+    print(f"tSNE of {len(data)} spectra:")
+    for engine in ut.TSNE_ENGINES:
+        t, embedding = timeit(
+            ut.dim_reduce,
+            data,
+            "tsne",
+            engine=engine,
+            perplexity=perplexity,
+            random_state=0,
+            n_repeats=1,
+        )
+        score = neighbourhood_preservation(data, embedding)
+        print(f"  {engine:>20}: {t:.3f}s, neighbourhood preservation {score:.3f}")
+
+
+if __name__ == "__main__":
+    check_exact_ids()
+    bench_parse_coefficients()
+    bench_is_polluted()
+    bench_tsne_engines()
@@ -2,39 +2,239 @@
 check_pollution.py
 ============================
 Functionality to check whether a given WD is known to be polluted.
+
+The labels from each dataset are resolved once, by `build_label_table`, into a
+compact table keyed by Gaia ID (`data/interim/pollution_labels.npz`).
+Nothing is loaded on import: the table is read on the first query, and rebuilt
+automatically if any of the datasets' .csv files have changed.
+All IDs, from the datasets or queries, are converted to exact int64 keys (see
+`as_gaia_ids`); float64 can't represent 19-digit Gaia IDs exactly.
 """
 
+import functools
+import os
+
 import numpy as np
 import pandas as pd
 
+import profiling as pr
+
+EVALUATION_DIR = "../data/external/evaluation"
+SOURCE_FILES = {
+    "gf21sdss": f"{EVALUATION_DIR}/gf21_sdss.csv",
+    "mwdd": f"{EVALUATION_DIR}/mwdd.csv",
+    "pewdd": f"{EVALUATION_DIR}/pewdd.csv",
+}
+DATASETS = list(SOURCE_FILES)  # Order of the columns of the label table
+LABEL_TABLE_FILE = "../data/interim/pollution_labels.npz"
+LABEL_TABLE_VERSION = 2  # Bump when the labelling changes, to force a rebuild
+MAX_EXACT_FLOAT_ID = 2**53  # Larger IDs can't be stored exactly as float64
+UNKNOWN = (-1,) * (len(DATASETS) + 1)  # Labels of a WD in none of the datasets
+
+
+# --------------------------
+# Canonical Gaia ID keys
+
+
+def as_gaia_ids(ids):
+    """
+    Converts Gaia IDs to exact int64 keys. Accepts integers, strings (e.g.
+     "1234" or "Gaia DR3 1234"), and floats which are exact integers below 2**53.
+    Raises a ValueError for other floats, as these may not be the IDs intended.
+    """
+    ids = np.asarray(ids)
+    if ids.dtype.kind in "iu":
+        return ids.astype(np.int64)
+    if ids.dtype.kind == "f":
+        if np.any((np.abs(ids) >= MAX_EXACT_FLOAT_ID) | (ids != np.round(ids))):
+            raise ValueError("Float IDs can only be exact below 2**53; use int64")
+        return ids.astype(np.int64)
+    strings = pd.Series(ids.ravel()).astype(str)
+    strings = strings.str.replace(r"Gaia E?DR[23] ", "", regex=True).str.strip()
+    return strings.astype(np.int64).values.reshape(ids.shape)
+
+
+def as_gaia_id(id_):
+    "Converts a single Gaia ID to an exact int key (see `as_gaia_ids`)"
+    if isinstance(id_, (int, np.integer)):
+        return int(id_)
+    return int(as_gaia_ids([id_])[0])
+
+
 # --------------------------
 # Loading external datasets
 
-# GF21xSDSS
-gf21sdss = pd.read_csv(
-    "../data/external/evaluation/gf21_sdss.csv"
-)  # 41820 rows, from VizieR
-gf21sdss.drop_duplicates(subset="GaiaEDR3", inplace=True)  # 41820 -> 32169
-gf21sdss.set_index("GaiaEDR3", inplace=True)
-gf21sdss_index = set(gf21sdss.index)  # Convert to set for faster checking
-
-# MWDD
-mwdd = pd.read_csv(
-    "../data/external/evaluation/mwdd.csv"
-)  # 70698 rows, from MWDD 2024-11-06
-mwdd.drop_duplicates(subset="gaiaedr3", inplace=True)  # 70698 -> 61198
-mwdd.dropna(inplace=True)  # 61198 -> 56745
-mwdd.set_index("gaiaedr3", inplace=True)
-mwdd_index = set(mwdd.index)
-
-# PEWDD
-pewdd = pd.read_csv(
-    "../data/external/evaluation/pewdd.csv"
-)  # 3546 rows, from Github 2024-11-06
-pewdd.set_index("Gaia_designation", inplace=True)
-pewdd = pewdd[pewdd.index.fillna("").str.startswith("Gaia DR3")]  # 3546 -> 2979
-pewdd.index = pewdd.index.str.replace("Gaia DR3 ", "")
-pewdd_index = set(pewdd.index)
+
+@functools.lru_cache(maxsize=None)
+@pr.profiled(rows=len)
+def load_gf21sdss():
+    "GF21xSDSS, indexed by Gaia EDR3 ID"
+    gf21sdss = pd.read_csv(
+        SOURCE_FILES["gf21sdss"], dtype={"GaiaEDR3": "Int64"}
+    )  # 41820 rows, from VizieR
+    gf21sdss.drop_duplicates(subset="GaiaEDR3", inplace=True)  # 41820 -> 32169
+    gf21sdss.set_index("GaiaEDR3", inplace=True)
+    gf21sdss.index = as_gaia_ids(gf21sdss.index)
+    return gf21sdss
+
+
+@functools.lru_cache(maxsize=None)
+@pr.profiled(rows=len)
+def load_mwdd():
+    "MWDD, indexed by Gaia EDR3 ID"
+    mwdd = pd.read_csv(
+        SOURCE_FILES["mwdd"], dtype={"gaiaedr3": "Int64"}  # Exact IDs, despite NaNs
+    )  # 70698 rows, from MWDD 2024-11-06
+    mwdd.drop_duplicates(subset="gaiaedr3", inplace=True)  # 70698 -> 61217
+    mwdd.dropna(inplace=True)  # 61217 -> 56764
+    mwdd.set_index("gaiaedr3", inplace=True)
+    mwdd.index = as_gaia_ids(mwdd.index)
+    return mwdd
+
+
+@functools.lru_cache(maxsize=None)
+@pr.profiled(rows=len)
+def load_pewdd():
+    "PEWDD, indexed by Gaia DR3 ID"
+    pewdd = pd.read_csv(SOURCE_FILES["pewdd"])  # 3546 rows, from Github 2024-11-06
+    pewdd.set_index("Gaia_designation", inplace=True)
+    pewdd = pewdd[pewdd.index.fillna("").str.startswith("Gaia DR3")]  # 3546 -> 2979
+    pewdd.index = as_gaia_ids(pewdd.index)  # Also strips stray whitespace
+    return pewdd
+
+
+# --------------------------
+# Resolving the labels of every WD in each dataset at once
+
+
+def label_gf21sdss(spec_classes):
+    """
+    Labels GF21xSDSS specClasses:
+    - 1: if specClass contains "Z" but doesn't end in "Z:"
+    - -1: if specClass is "Unreli", "WD", or "UNKN", or ends in "Z:"
+    - 0: otherwise
+    """
+    cl = pd.Series(spec_classes).astype(str)
+    is_unsure = cl.isin(["Unreli", "WD", "UNKN"]) | cl.str.endswith("Z:")
+    is_polluted = cl.str.contains("Z") & ~cl.str.endswith("Z:")
+    return np.select([is_polluted, is_unsure], [1, -1], 0).astype(np.int8)
+
+
+def label_mwdd(spectypes):
+    """
+    Labels MWDD spectypes:
+    - 1: if classified as D*Z*, without "Z?", "Z:", "+" or "/"
+    - -1: if classified as CND, D, or '?', or D*Z* with a '?' or ':'
+    - 0: classified as something else
+    """
+    cl = pd.Series(spectypes).astype(str)
+    has_z = cl.str.contains("Z")
+    is_disqualified = cl.str.contains(r"Z\?|Z:|\+|/", regex=True)
+    is_unsure = cl.str.contains("?", regex=False) | cl.str.contains(":")
+    return np.select(
+        [
+            has_z & ~is_disqualified,
+            has_z & is_unsure,
+            cl.isin(["CND", "D", "?"]),
+        ],
+        [1, -1, -1],
+        0,
+    ).astype(np.int8)
+
+
+def source_stamp():
+    """
+    Identifies the current versions of the datasets' .csv files (size, mtime),
+     and of the labelling (`LABEL_TABLE_VERSION`)
+    """
+    return np.array(
+        [f"v{LABEL_TABLE_VERSION}"]
+        + [
+            f"{os.path.getsize(fname)}:{os.stat(fname).st_mtime_ns}"
+            for fname in SOURCE_FILES.values()
+        ]
+    )
+
+
+@pr.profiled()
+def build_label_table(path=LABEL_TABLE_FILE):
+    """
+    Resolves the label of every WD in each dataset, saving them to `path`:
+    - `ids`: every Gaia ID in any of the datasets, sorted (N,)
+    - `labels`: the label from each dataset, in the order of `DATASETS` (N, 3)
+    - `combined`: the overall label, as from `is_polluted` (N,)
+    - `stamp`: the `source_stamp` of the .csv files it was built from
+    """
+    print("Building pollution label table...")
+    gf21sdss = load_gf21sdss()
+    mwdd = load_mwdd()
+    pewdd = load_pewdd()
+    pewdd_ids = pewdd.index.unique().values
+
+    dataset_labels = [
+        (gf21sdss.index.values, label_gf21sdss(gf21sdss["specClass"])),
+        (mwdd.index.values, label_mwdd(mwdd["spectype"])),
+        (pewdd_ids, np.ones(len(pewdd_ids), dtype=np.int8)),
+    ]
+    ids = np.unique(np.concatenate([keys for keys, _ in dataset_labels]))
+    labels = np.full((len(ids), len(DATASETS)), -1, dtype=np.int8)
+    for j, (keys, dataset_label) in enumerate(dataset_labels):
+        labels[np.searchsorted(ids, keys), j] = dataset_label
+
+    # Polluted > non-polluted > unknown, i.e. the maximum of the labels
+    combined = labels.max(axis=1)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, ids=ids, labels=labels, combined=combined, stamp=source_stamp())
+
+
+@functools.lru_cache(maxsize=None)
+@pr.profiled(rows=lambda table: len(table["ids"]))
+def load_label_table(path=LABEL_TABLE_FILE):
+    """
+    Loads the label table (once per process), (re)building it if it doesn't exist
+     or the datasets' .csv files have changed since it was built.
+    """
+    if os.path.exists(path):
+        with np.load(path) as fl:
+            table = dict(fl)
+        if np.array_equal(table["stamp"], source_stamp()):
+            return table
+    build_label_table(path)
+    with np.load(path) as fl:
+        return dict(fl)
+
+
+def lookup_labels(ids):
+    """
+    Looks up the labels of `ids` in the label table.
+    Returns:
+    - labels: the label from each dataset (len(ids), 3), -1 where not present
+    - combined: the overall label (len(ids),), -1 where not present
+    """
+    table = load_label_table()
+    ids = as_gaia_ids(ids)
+    if len(table["ids"]) == 0:
+        return (
+            np.full((len(ids), len(DATASETS)), -1, dtype=np.int8),
+            np.full(len(ids), -1, dtype=np.int8),
+        )
+    pos = np.searchsorted(table["ids"], ids).clip(max=len(table["ids"]) - 1)
+    found = table["ids"][pos] == ids
+    labels = np.where(found[:, None], table["labels"][pos], -1).astype(np.int8)
+    combined = np.where(found, table["combined"][pos], -1).astype(np.int8)
+    return labels, combined
+
+
+@functools.lru_cache(maxsize=None)
+def label_index():
+    """
+    Dict of Gaia ID (int) -> labels (gf21sdss, mwdd, pewdd, combined), shared by
+     the scalar checks below, so that each lookup is a single hash of an int.
+    """
+    table = load_label_table()
+    rows = np.column_stack([table["labels"], table["combined"]]).tolist()
+    return dict(zip(table["ids"].tolist(), map(tuple, rows)))
 
 
 # --------------------------
@@ -49,26 +249,15 @@ def is_polluted(id_):
     - (-1, -1, -1) -> -1  (None of the datasets are conclusive)
     - (1, 0, -1) -> 1  (A dataset saying it's polluted supercedes one saying it's not)
     """
-    # If any of the datasets classify the object as polluted, return 1
-    # Check them in order so we can return early if a dataset classes the object as polluted
-    mwdd_polluted = check_mwdd(id_)
-    if mwdd_polluted == 1:
-        return 1
-    gf21sdss_polluted = check_gf21sdss(id_)
-    if gf21sdss_polluted == 1:
-        return 1
-    pewdd_polluted = check_pewdd(id_)
-    if pewdd_polluted == 1:
-        return 1
-
-    # If we get to this stage, none of the datasets classify the object as polluted
-    checklist = np.array([gf21sdss_polluted, mwdd_polluted, pewdd_polluted])
-    # If any of the datasets classify the object as non-polluted, but
-    # none of them classify it as polluted, return 0
-    if 0 in checklist:
-        return 0
-    # If none of the datasets are conclusive, return -1
-    return -1
+    return label_index().get(as_gaia_id(id_), UNKNOWN)[-1]
+
+
+def is_polluted_many(ids):
+    """
+    Vectorised `is_polluted`, labelling a whole array of Gaia EDR3 IDs at once.
+    Returns an int8 array of 1 (polluted), 0 (not polluted) or -1 (unknown).
+    """
+    return lookup_labels(ids)[1]
 
 
 def check_gf21sdss(id_):
@@ -80,16 +269,7 @@ def check_gf21sdss(id_):
             or ends in "Z:"
     - False: otherwise
     """
-    if id_ in gf21sdss_index:
-        cl = gf21sdss.loc[id_, "specClass"]
-        if "Z" in cl and not cl.endswith("Z:"):  # Polluted
-            return 1
-        if cl in ["Unreli", "WD", "UNKN"] or cl.endswith("Z:"):  # Not sure
-            return -1
-        # else
-        return 0  # Not polluted
-    # else
-    return -1  # Not sure - not in GF21xSDSS
+    return label_index().get(as_gaia_id(id_), UNKNOWN)[0]
 
 
 def check_mwdd(id_):
@@ -100,20 +280,7 @@ def check_mwdd(id_):
     - None: if the object is classified as CND, D, or '?', or isn't in the dataset
     - False: classified as something else
     """
-    disqualifying_substrings = ["Z?", "Z:", "+", "/"]
-    if float(id_) in mwdd_index:
-        cl = mwdd.loc[id_, "spectype"]
-        if "Z" in cl:
-            if not any(ss in cl for ss in disqualifying_substrings):  # Polluted
-                return 1
-            if "?" in cl or ":" in cl:  # Not sure, e.g. DZ?, DZ:d
-                return -1
-        if cl in ["CND", "D", "?"]:  # Not sure
-            return -1
-        # else
-        return 0  # Not polluted
-    # else
-    return -1  # Not sure - not in MWDD
+    return label_index().get(as_gaia_id(id_), UNKNOWN)[1]
 
 
 def check_pewdd(id_):
@@ -123,7 +290,10 @@ def check_pewdd(id_):
     - True: if the object is in the dataset
     - None: otherwise
     """
-    if str(id_) in pewdd_index:  # Polluted
-        return 1
-    # else
-    return -1  # Not sure - not in PEWDD
+    return label_index().get(as_gaia_id(id_), UNKNOWN)[2]
+
+
+if __name__ == "__main__":
+    # (Re)builds the label table
+    build_label_table()
+    pr.write_report()
@@ -7,9 +7,9 @@ Creates figures identifying interesting features in the tSNE embedding.
 import sys
 
 import check_polluted as cp
+import gf21_catalogue as gf
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 
 FIGURE_NUMBERS = [int(sys.argv[i]) for i in range(1, len(sys.argv))]
 
@@ -20,7 +20,7 @@ fl = np.load("../data/processed/tsne_xp.npz")
 ids = fl["ids"]  # (107 164,)
 embedding = fl["embedding"]  # (107 164, 2)
 
-gf21 = pd.read_csv("../data/interim/gf21_filtered.csv", index_col=0)
+gf21_ids = gf.catalogue_ids()
 
 
 # =============================================================================
@@ -29,12 +29,12 @@ gf21 = pd.read_csv("../data/interim/gf21_filtered.csv", index_col=0)
 # -----------------------------------------------------------------------------
 # Load the colour data for the DAs
 
-DA_ids = cp.gf21sdss.query('specClass == "DA"').index.values  # (18 927,)
+DA_ids = cp.load_gf21sdss().query('specClass == "DA"').index.values  # (18 927,)
 DA_ids_in_sample = np.intersect1d(DA_ids, ids)  # (7 423,)
 is_DA = np.isin(ids, DA_ids_in_sample)  # (107 164,), 7 423 True
 
-DA_mags = gf21.loc[ids[is_DA], ["BPmag", "RPmag"]]  # (7 423, 2)
-DA_BPRPs = (DA_mags["BPmag"] - DA_mags["RPmag"]).values  # (7 423,)
+DA_mags = gf.lookup(ids[is_DA], ["BPmag", "RPmag"])  # 2 x (7 423,)
+DA_BPRPs = DA_mags["BPmag"] - DA_mags["RPmag"]  # (7 423,)
 
 # -----------------------------------------------------------------------------
 # Plot
@@ -71,8 +71,8 @@ fg.savefig(
 
 def class_mask(class_str):
     "Creates a mask for objects in a given class, acc. GF+21"
-    class_ids = cp.gf21sdss.query(f'specClass == "{class_str}"').index.values
-    return np.isin(ids, np.intersect1d(gf21.index, class_ids))
+    class_ids = cp.load_gf21sdss().query(f'specClass == "{class_str}"').index.values
+    return np.isin(ids, np.intersect1d(gf21_ids, class_ids))
 
 
 isDB = class_mask("DB")
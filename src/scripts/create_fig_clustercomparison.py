@@ -6,21 +6,21 @@ Compares the effective temperatures of the two DZ clusters identified.
 
 import sys
 
+import gf21_catalogue as gf
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 
 FIGURE_NUMBER = int(sys.argv[1])
 
 # Loading data
-gf21 = pd.read_csv("../data/interim/gf21_filtered_moredata.csv", index_col=0)
+GF21_FILE = "../data/interim/gf21_filtered_moredata.csv"
 
 fl = np.load("../data/processed/polluted_islands.npz")
 cool_DZs = fl["cool_DZs"]
 warm_DZs = fl["warm_DZs"]
 
-cool_TeffH = gf21.loc[cool_DZs].TeffH / 1e3
-warm_TeffH = gf21.loc[warm_DZs].TeffH / 1e3
+cool_TeffH = gf.lookup(cool_DZs, "TeffH", GF21_FILE) / 1e3
+warm_TeffH = gf.lookup(warm_DZs, "TeffH", GF21_FILE) / 1e3
 
 # Plotting
 BINS = np.arange(5.5, 13, 0.5)
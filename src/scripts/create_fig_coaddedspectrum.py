@@ -11,10 +11,11 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import preprocessors as pp
+import xp_store as xs
 
 FIGURE_NUMBER = int(sys.argv[1])
 
-fl = np.load("../data/interim/xp_sampled.npz")
+fl = xs.load_store("../data/interim/xp_sampled")
 ids = fl["ids"]
 WLEN = fl["wlen"]
 flux = fl["flux"]
@@ -23,7 +24,7 @@ normalised_flux = pp.divide_Gflux(flux, ids)
 # tSNE unknown sources
 fl = np.load("../data/processed/polluted_islands.npz")
 tsne_pwds = np.concatenate((fl["cool_DZs"], fl["warm_DZs"]))
-tsne_unknown_ids = np.array([id_ for id_ in tsne_pwds if cp.is_polluted(id_) == -1])
+tsne_unknown_ids = tsne_pwds[cp.is_polluted_many(tsne_pwds) == -1]
 
 # Sources identified by just tSNE
 garciazamora25 = pd.read_csv(
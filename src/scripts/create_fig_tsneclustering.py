@@ -9,20 +9,18 @@ import sys
 import matplotlib.colors as mcolors
 import matplotlib.pyplot as plt
 import numpy as np
-from sklearn.cluster import DBSCAN
+
+import tsne_clustering as tc
 
 FIGURE_NUMBER = int(sys.argv[1])
 
-fl = np.load("../data/processed/tsne_xp.npz")
-ids = fl["ids"]
-tsne_embedding = fl["embedding"]
+clustering = tc.load_clustering()  # DBSCAN(eps=2, min_samples=30), cached
+tsne_embedding = clustering["embedding"]
+labels = clustering["labels"]
 
 fl = np.load("../data/processed/umap_xp.npz")
 umap_embedding = fl["embedding"]
 
-dbscan = DBSCAN(eps=2, min_samples=30)
-dbscan.fit(tsne_embedding)
-
 fg, axs = plt.subplot_mosaic(
     [["tsne_clustered", "umap"], ["cbar", "cbar"]],
     figsize=(10, 5),
@@ -31,33 +29,31 @@ fg, axs = plt.subplot_mosaic(
 
 ax = axs["tsne_clustered"]
 dcmp = plt.cm.viridis
-cols = [
-    dcmp(0.08),
-    dcmp(0.16),
-    dcmp(0.24),
-    dcmp(0.32),
-    "orange",
-    dcmp(0.4),
-    "r",
-    dcmp(0.48),
-    dcmp(0.56),
-    dcmp(0.64),
-    dcmp(0.72),
-    dcmp(0.0),
+# The polluted islands in orange and red, noise in dark purple, and the other
+# clusters in increasingly light shades, in order
+shades = [dcmp(0.08 * (j + 1)) for j in range(9)]
+other_clusters = [
+    i
+    for i in np.unique(labels)
+    if i >= 0 and i not in (clustering["cool"], clustering["warm"])
 ]
+cols = {
+    clustering["cool"]: "orange",
+    clustering["warm"]: "r",
+    -1: dcmp(0.0),
+    **dict(zip(other_clusters, shades)),
+}
 
-for i in np.unique(dbscan.labels_):
+for i in np.unique(labels):
     ax.scatter(
-        tsne_embedding[dbscan.labels_ == i, 0],
-        tsne_embedding[dbscan.labels_ == i, 1],
+        tsne_embedding[labels == i, 0],
+        tsne_embedding[labels == i, 1],
         color=cols[i],
         s=0.1,
         alpha=0.5,
     )
 
-cmap = mcolors.ListedColormap(
-    [cols[4], cols[6], cols[-1]] + cols[0:4] + [cols[5]] + cols[7:-1]
-)
+cmap = mcolors.ListedColormap(["orange", "r", dcmp(0.0)] + shades)
 cbar = plt.colorbar(
     plt.cm.ScalarMappable(cmap=cmap), cax=axs["cbar"], orientation="horizontal"
 )
@@ -66,10 +62,10 @@ cbar.set_ticklabels(["Cool", "Warm"], fontsize=12)
 cbar.set_label(r"DBSCAN clustering of $t$SNE embedding", fontsize=14, labelpad=0)
 
 ax = axs["umap"]
-for i in np.unique(dbscan.labels_):
+for i in np.unique(labels):
     ax.scatter(
-        umap_embedding[dbscan.labels_ == i, 0],
-        umap_embedding[dbscan.labels_ == i, 1],
+        umap_embedding[labels == i, 0],
+        umap_embedding[labels == i, 1],
         color=cols[i],
         s=0.1,
         alpha=0.5,
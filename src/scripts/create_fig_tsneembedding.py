@@ -17,7 +17,7 @@ fl = np.load("../data/processed/tsne_xp.npz")
 ids = fl["ids"]
 tsne_embedding = fl["embedding"]
 
-isp = np.array([cp.is_polluted(id_) for id_ in ids])
+isp = cp.is_polluted_many(ids)
 
 
 fg, ax = plt.subplots(
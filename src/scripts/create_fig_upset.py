@@ -55,14 +55,14 @@ DZ_dict = {
 }
 
 known_DZ_dict = {
-    key: np.array([idd for idd in id_array if cp.is_polluted(idd) == 1])
+    key: np.asarray(id_array)[cp.is_polluted_many(id_array) == 1]
     for key, id_array in DZ_dict.items()
 }
 
 upset_df = upsetplot.from_contents(DZ_dict)
-upset_df["pollution_status"] = [
-    "Known polluted" if cp.is_polluted(idd) == 1 else "All" for idd in upset_df.id
-]
+upset_df["pollution_status"] = np.where(
+    cp.is_polluted_many(upset_df.id.values) == 1, "Known polluted", "All"
+)
 
 # ============
 # Plotting
@@ -1,31 +1,18 @@
 """
 create_figs.py
 ==============
-Orchestrator script to create all the figures
+Orchestrator script to create all the figures.
+Runs the figure stages of the pipeline (see `pipeline.py`), so every figure is
+created again, in parallel.
+The stages the figures depend on (e.g. the embeddings) aren't run; any whose
+outputs are missing or out of date are reported, to be run with `pipeline.py`.
 """
 
-import subprocess
-
-SCRIPT_ARGUMENTS = {
-    "create_fig_tsneembedding.py": 1,
-    "create_fig_tsneclustering.py": 2,
-    "create_fig_coaddedspectrum.py": 3,
-    "create_fig_classes.py": [4, 5, 6],
-    "create_fig_upset.py": 7,
-    "create_fig_whytwoislands.py": 8,
-    "create_fig_clustercomparison.py": 9,
-}
+import pipeline as pl
 
 
 def main():
-    for script, figure_number in SCRIPT_ARGUMENTS.items():
-        # Handle multiple arguments
-        if isinstance(figure_number, list):
-            print(f"Creating figures: {', '.join(map(str, figure_number))}...")
-            subprocess.run(["python", script] + [str(fig) for fig in figure_number])
-        else:
-            print(f"Creating figure {figure_number}...")
-            subprocess.run(["python", script, str(figure_number)])
+    pl.run(pl.FIGURE_STAGES, force=True, only=True)
 
 
 if __name__ == "__main__":
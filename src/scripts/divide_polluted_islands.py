@@ -3,47 +3,93 @@ divide_polluted_islands.py
 ==========================
 Runs tSNE with the polluted islands and a fraction of the rest of the objects, to show
 how it is the other islands which cause the split in the two islands.
+The fractions are run in parallel, each on its share of the cores.
+With `WARM_START`, each run starts from the full tSNE's coordinates of the selected
+objects (`data/processed/tsne_xp.npz`), rather than from PCA, so it converges in
+fewer iterations.
 """
 
-import numpy as np
-import preprocessors as pp
-from umap_tsne_xp import dim_reduce
+import os
+from concurrent.futures import ProcessPoolExecutor
 
-# Load XP spectra
-fl = np.load("../data/interim/xp_coeffs.npz")
-ids = fl["ids"]
-xp = fl["xp"]
-pxp = pp.divide_Gflux(xp, ids)
+import numpy as np
 
-# Load polluted candidates (acc. tSNE)
-fl = np.load("../data/processed/polluted_islands.npz")
-cool_DZs = fl["cool_DZs"]
-warm_DZs = fl["warm_DZs"]
-DZs = np.concatenate([cool_DZs, warm_DZs])
+import preprocessors as pp
+import profiling as pr
+import sweep_dim_reduce as sw
+import xp_store as xs
+from umap_tsne_xp import dim_reduce, rescale_init
 
+XP_COEFFS_STORE = "../data/interim/xp_coeffs"
 FRACTIONS_OTHER_SOURCES = [0, 0.04, 0.10, 0.25]
-other_sources = np.array([source for source in ids if source not in DZs])
+WARM_START = False
+WARM_START_MAX_ITER = 500  # Instead of sklearn's default of 1000
+N_WORKERS = len(FRACTIONS_OTHER_SOURCES)
 
-for fraction in FRACTIONS_OTHER_SOURCES:
-    print(f"Running tSNE with {fraction:.2f} of other sources...")
-    np.random.seed(42)
-    # Select a fraction of the other sources
+
+def select_ids(ids, DZs, fraction, seed=42):
+    """
+    Selects the polluted candidates `DZs` and a random `fraction` of the other
+     sources, in the same order as in `ids`
+    """
+    other_sources = ids[~np.isin(ids, DZs)]
+    np.random.seed(seed)
     n_other = int(fraction * len(other_sources))
     fraction_of_other_sources = np.random.choice(
         other_sources, size=n_other, replace=False
     )
+    selected = np.concatenate([DZs, fraction_of_other_sources])
+    return ids[np.isin(ids, selected)]
 
-    # Combine with the polluted islands
-    selected_ids = np.concatenate([DZs, fraction_of_other_sources])
-    selected_ids = ids[np.isin(ids, selected_ids)]  # Get in same order as in `ids`
-    selected_pxps = pxp[np.isin(ids, selected_ids)]
-
-    # Run tSNE on the subset
-    embedding = dim_reduce(selected_pxps, "tsne", perplexity=50)
 
-    # Save the results
-    np.savez_compressed(
-        f"../data/processed/tsne_xp_polluted_islands_plus_fraction{fraction:.2f}.npz",
-        ids=selected_ids,
-        embedding=embedding,
+def embed_selection(selected_ids, init=None):
+    "Runs tSNE on the G-flux-normalised XP coefficients of `selected_ids`"
+    xp = xs.load_rows(XP_COEFFS_STORE, selected_ids, names=["xp"])["xp"]
+    pxp = pp.divide_Gflux(xp, selected_ids, out=xp)  # In place
+    if init is None:
+        return dim_reduce(pxp, "tsne", perplexity=50)
+    return dim_reduce(
+        pxp, "tsne", perplexity=50, init=init, max_iter=WARM_START_MAX_ITER
     )
+
+
+if __name__ == "__main__":
+    # Load IDs of the XP spectra
+    ids = np.asarray(xs.load_store(XP_COEFFS_STORE)["ids"])
+
+    # Load polluted candidates (acc. tSNE)
+    fl = np.load("../data/processed/polluted_islands.npz")
+    cool_DZs = fl["cool_DZs"]
+    warm_DZs = fl["warm_DZs"]
+    DZs = np.concatenate([cool_DZs, warm_DZs])
+
+    if WARM_START:
+        fl = np.load("../data/processed/tsne_xp.npz")
+        full_embedding = {"ids": fl["ids"], "embedding": fl["embedding"]}
+
+    selections = {}
+    for fraction in FRACTIONS_OTHER_SOURCES:
+        selected_ids = select_ids(ids, DZs, fraction)
+        init = None
+        if WARM_START:
+            rows = xs.select_rows(full_embedding, selected_ids)
+            init = rescale_init(full_embedding["embedding"][rows])
+        selections[fraction] = (selected_ids, init)
+
+    n_threads = max(1, os.cpu_count() // N_WORKERS)
+    with ProcessPoolExecutor(
+        max_workers=N_WORKERS, initializer=sw.limit_threads, initargs=(n_threads,)
+    ) as pool:
+        futures = {}
+        for fraction, selection in selections.items():
+            print(f"Running tSNE with {fraction:.2f} of other sources...")
+            futures[fraction] = pool.submit(embed_selection, *selection)
+
+        for fraction, future in futures.items():
+            # Save the results
+            np.savez_compressed(
+                f"../data/processed/tsne_xp_polluted_islands_plus_fraction{fraction:.2f}.npz",
+                ids=selections[fraction][0],
+                embedding=future.result(),
+            )
+    pr.write_report()
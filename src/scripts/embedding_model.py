@@ -0,0 +1,339 @@
+"""
+embedding_model.py
+==================
+Places new sources into an existing tSNE embedding (`data/processed/tsne_xp.npz`),
+without rerunning tSNE on the whole sample.
+The model is a store (see `xp_store.py`), `data/interim/tsne_model/`, holding the
+reference sources' IDs, preprocessed XP coefficients and embedding coordinates,
+with the (fitted) preprocessor of the coefficients pickled alongside, so new
+sources are preprocessed the same way.
+The neighbour index is a brute-force search over the memory-mapped coefficients,
+which needs no building when the model is loaded.
+New spectra are placed either by interpolating the coordinates of their nearest
+reference neighbours ("knn", the fast path), or by then optimising the tSNE cost of
+only the new points, with the reference points held fixed ("optimise"), which
+costs ~5-15 ms per source (see `project`).
+The fitted UMAP reducer (see `umap_tsne_xp.fit_umap`) is also kept, pickled with
+its search index and its (fitted) preprocessor, in `data/interim/umap_model.pkl`,
+so new sources can be embedded into `data/processed/umap_xp.npz` with
+`transform_umap`, as a query against the index rather than a refit.
+"""
+
+import functools
+import os
+import pickle
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+import preprocessors as pp
+import profiling as pr
+import xp_store as xs
+
+MODEL_DIR = "../data/interim/tsne_model"
+PREPROCESSOR_FILE = "preprocessor.pkl"  # In the model's directory
+PERPLEXITY = 50  # As used for `tsne_xp.npz` in `umap_tsne_xp.py`
+UMAP_MODEL_FILE = "../data/interim/umap_model.pkl"
+CHUNK_SIZE = 10_000  # Rows of XP coefficients read and transformed at once
+BATCH_SIZE = 64  # Bounds the (BATCH_SIZE, N) arrays in `optimise_points`
+N_LOCAL = 200  # Reference points repelling each new point at every iteration
+FAR_EVERY = 50  # Iterations between updates of the repulsion of all the others
+
+
+# --------------------------
+# tSNE
+
+
+def build_model(
+    ids,
+    data,
+    embedding,
+    path=MODEL_DIR,
+    perplexity=PERPLEXITY,
+    preprocessor="divide_Gflux",
+):
+    """
+    Saves a model of the embedding of the (preprocessed) `data` to `path`.
+    `perplexity` should be the one the embedding was made with, and `preprocessor`
+     the one `data` was made with (see `preprocess`; a chain should be fitted).
+    """
+    xs.save_store(
+        path,
+        ids=np.asarray(ids, dtype=np.int64),
+        data=np.asarray(data, dtype=np.float32),
+        embedding=np.asarray(embedding, dtype=np.float32),
+        perplexity=np.array(perplexity),
+    )
+    with open(os.path.join(path, PREPROCESSOR_FILE), "wb") as f:
+        pickle.dump(preprocessor, f)
+
+
+@functools.lru_cache(maxsize=None)
+def load_model(path=MODEL_DIR):
+    """
+    Opens the model at `path` (once per process), with its preprocessor (models
+     saved without one used "divide_Gflux"), and its neighbour indices in the data
+     and in the embedding
+    """
+    model = xs.load_store(path)
+    model["preprocessor"] = "divide_Gflux"
+    if os.path.exists(os.path.join(path, PREPROCESSOR_FILE)):
+        with open(os.path.join(path, PREPROCESSOR_FILE), "rb") as f:
+            model["preprocessor"] = pickle.load(f)
+    model["index"] = NearestNeighbors(algorithm="brute").fit(model["data"])
+    model["embedding_index"] = NearestNeighbors().fit(model["embedding"])
+    return model
+
+
+def conditional_affinities(distances, perplexity, n_steps=64):
+    """
+    tSNE's conditional probabilities p_j|i of each point's neighbours, from their
+     `distances` (N, k), with the Gaussian bandwidth of each point found by a
+     bisection search so that the distribution has the given `perplexity`.
+    """
+    sq_distances = distances**2 - distances[:, :1] ** 2  # For numerical stability
+    target_entropy = np.log(min(perplexity, distances.shape[1]))
+    beta_lo = np.zeros(len(distances))
+    beta_hi = np.full(len(distances), np.inf)
+    beta = np.ones(len(distances))
+    for _ in range(n_steps):
+        p = np.exp(-sq_distances * beta[:, None])
+        p /= p.sum(axis=1, keepdims=True)
+        entropy = -np.sum(p * np.log(np.maximum(p, 1e-300)), axis=1)
+        too_flat = entropy > target_entropy  # So narrow the Gaussian
+        beta_lo = np.where(too_flat, beta, beta_lo)
+        beta_hi = np.where(too_flat, beta_hi, beta)
+        beta = np.where(np.isinf(beta_hi), beta * 2, (beta_lo + beta_hi) / 2)
+    p = np.exp(-sq_distances * beta[:, None])  # With the final bandwidths
+    return p / p.sum(axis=1, keepdims=True)
+
+
+def student_t(y, points):
+    "The tSNE kernel 1 / (1 + |y - x|^2) between `y` (B, 2) and `points` (B, M, 2)"
+    return 1 / (1 + np.sum((y[:, None, :] - points) ** 2, axis=2))
+
+
+def far_field(y, reference, local_points):
+    """
+    The tSNE repulsion on points `y` (B, 2) from all the `reference` points (N, 2)
+     except their `local_points` (B, M, 2): its sum of Student-t kernels (B,), and
+     its (unnormalised) force (B, 2)
+    """
+    sq_distances = (
+        np.sum(y**2, axis=1)[:, None]
+        + np.sum(reference**2, axis=1)
+        - 2 * y @ reference.T
+    )
+    w = 1 / (1 + np.maximum(sq_distances, 0))
+    w_local = student_t(y, local_points)
+    far_z = w.sum(axis=1) - w_local.sum(axis=1)
+    far_force = (
+        y * (w**2).sum(axis=1, keepdims=True)
+        - w**2 @ reference
+        - np.einsum("bm,bmd->bd", w_local**2, y[:, None, :] - local_points)
+    )
+    return far_z, far_force
+
+
+def optimise_points(
+    init,
+    neighbours,
+    p,
+    reference,
+    local,
+    n_iter=200,
+    learning_rate=1.0,
+    far_every=FAR_EVERY,
+):
+    """
+    Minimises the tSNE cost KL(P||Q) of new points with respect to only their own
+     coordinates, starting from `init` (B, 2), with the `reference` (N, 2) fixed.
+    `neighbours` (B, k) are the reference points each new point is attracted to,
+     with probabilities `p` (B, k).
+    Repulsion is computed exactly from the `local` (B, M) reference points (those
+     nearest to `init` in the embedding) at every iteration, but from all the
+     others only every `far_every` iterations (see `far_field`), as it changes
+     slowly. Most iterations then cost O(B * M), rather than O(B * N).
+    Uses gradient descent with momentum and gains, as sklearn's TSNE.
+    """
+    y = init.astype(np.float64)
+    update = np.zeros_like(y)
+    gains = np.ones_like(y)
+    local_points = reference[local]
+    neighbour_points = reference[neighbours]
+    for i in range(n_iter):
+        momentum = 0.5 if i < 50 else 0.8
+        if i % far_every == 0:
+            far_z, far_force = far_field(y, reference, local_points)
+        w_local = student_t(y, local_points)
+        z = w_local.sum(axis=1) + far_z
+        repulsion = (
+            np.einsum("bm,bmd->bd", w_local**2, y[:, None, :] - local_points)
+            + far_force
+        ) / z[:, None]
+        attraction = student_t(y, neighbour_points) * p
+        grad = 4 * (
+            np.einsum("bk,bkd->bd", attraction, y[:, None, :] - neighbour_points)
+            - repulsion
+        )
+        same_sign = np.sign(grad) == np.sign(update)
+        gains = np.maximum(np.where(same_sign, gains * 0.8, gains + 0.2), 0.01)
+        update = momentum * update - learning_rate * gains * grad
+        y += update
+    return y
+
+
+def project(data, method="optimise", path=MODEL_DIR, n_neighbors=None, n_local=N_LOCAL):
+    """
+    Places the (preprocessed, as the model's) spectra `data` into the embedding.
+    `method` is "knn" (the affinity-weighted mean of the coordinates of the
+     `n_neighbors` nearest reference sources; the fast path, dominated by the
+     neighbour search), or "optimise" (starting from "knn", optimise the tSNE cost
+     of the new points alone, with exact repulsion from the `n_local` nearest
+     reference points in the embedding; see `optimise_points`). "optimise" is
+     more faithful, but slower: ~5 ms per source against 10^4 reference points, and
+     ~15 ms against 10^5 (vs <1 ms for "knn").
+    `n_neighbors` defaults to 3 * perplexity, as in tSNE.
+    Returns the coordinates (len(data), 2).
+    """
+    assert method in ["knn", "optimise"], 'Invalid method; must be "knn" or "optimise".'
+    model = load_model(path)
+    perplexity = float(model["perplexity"])
+    n_neighbors = n_neighbors or min(len(model["ids"]), int(3 * perplexity + 1))
+    reference = np.asarray(model["embedding"], dtype=np.float64)
+
+    data = np.asarray(data, dtype=np.float32)
+    coords = np.empty((len(data), reference.shape[1]))
+    for start in range(0, len(data), BATCH_SIZE):
+        batch = slice(start, start + BATCH_SIZE)
+        distances, neighbours = model["index"].kneighbors(
+            data[batch], n_neighbors=n_neighbors
+        )
+        p = conditional_affinities(distances, perplexity)
+        coords[batch] = np.einsum("bk,bkd->bd", p, reference[neighbours])
+        if method == "optimise":
+            local = model["embedding_index"].kneighbors(
+                coords[batch],
+                n_neighbors=min(n_local, len(reference)),
+                return_distance=False,
+            )
+            coords[batch] = optimise_points(
+                coords[batch], neighbours, p, reference, local
+            )
+    return coords
+
+
+def project_ids(ids, method="optimise", path=MODEL_DIR):
+    """
+    Places the sources with Gaia IDs `ids` into the embedding, from their XP
+     coefficients in `data/interim/xp_coeffs`, preprocessed as the model's.
+    """
+    preprocessor = load_model(path)["preprocessor"]
+    names = ["xp"]
+    if isinstance(preprocessor, dict) and "error_weight" in preprocessor["steps"]:
+        names += ["xp_err"]
+    if isinstance(preprocessor, dict) and "error_weight_cov" in preprocessor["steps"]:
+        names += ["xp_err", "xp_corr"]
+    rows = xs.load_rows("../data/interim/xp_coeffs", ids, names=sorted(set(names)))
+    pxp = preprocess(
+        rows["xp"], ids, preprocessor, rows.get("xp_err"), rows.get("xp_corr")
+    )
+    return project(pxp, method, path)
+
+
+# --------------------------
+# UMAP
+
+
+def save_umap_model(reducer, path=UMAP_MODEL_FILE, preprocessor="divide_Gflux"):
+    """
+    Saves a fitted UMAP `reducer`, along with the preprocessor of its input: a
+     (fitted) chain (see `preprocessors.chain`), or the name of a function in
+     `preprocessors.py`.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        pickle.dump({"reducer": reducer, "preprocessor": preprocessor}, f)
+
+
+@functools.lru_cache(maxsize=None)
+def load_umap_model(path=UMAP_MODEL_FILE):
+    "Loads the UMAP model at `path` (once per process)"
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def fit_preprocess(xp, ids, preprocessor, xp_err=None, xp_corr=None):
+    """
+    Applies `preprocessor` to `xp`: a chain (see `preprocessors.chain`), the names
+     of the chain's steps joined by "+" (e.g. "divide_Gflux+error_weight"; fitted
+     to `xp` first), or the name of a function in `preprocessors.py`.
+    Error-weighting chains also need the errors `xp_err` (and `xp_corr`) of `xp`.
+    Returns the preprocessor to apply to other sources the same way (the fitted
+     chain, for names of steps), and the output.
+    """
+    if isinstance(preprocessor, dict):
+        return preprocessor, pp.transform(
+            preprocessor, xp, ids, xp_err=xp_err, xp_corr=xp_corr
+        )
+    if "+" in preprocessor or preprocessor in pp.ERROR_STEPS:
+        chain = pp.chain(*preprocessor.split("+"))
+        return pp.fit_transform(chain, xp, ids, xp_err=xp_err, xp_corr=xp_corr)
+    if preprocessor == "divide_Gflux":
+        return preprocessor, pp.divide_Gflux(xp, ids)
+    return preprocessor, getattr(pp, preprocessor)(xp)
+
+
+def preprocess(xp, ids, preprocessor, xp_err=None, xp_corr=None):
+    "Applies `preprocessor` to `xp` (see `fit_preprocess`)"
+    return fit_preprocess(xp, ids, preprocessor, xp_err, xp_corr)[1]
+
+
+def transform_umap(
+    xp, ids, path=UMAP_MODEL_FILE, chunk_size=CHUNK_SIZE, xp_err=None, xp_corr=None
+):
+    """
+    Embeds raw XP coefficients `xp` (e.g. memory-mapped from a store) of the
+     sources `ids` into the fitted UMAP, `chunk_size` rows at a time, applying the
+     model's preprocessor first (which needs `xp_err`, and maybe `xp_corr`, if it
+     error-weights).
+    Returns the coordinates (len(xp), n_components).
+    """
+    model = load_umap_model(path)
+    reducer = model["reducer"]
+    coords = np.empty((len(xp), reducer.n_components), dtype=np.float32)
+    for start in range(0, len(xp), chunk_size):
+        rows = slice(start, start + chunk_size)
+        pxp = preprocess(
+            np.asarray(xp[rows]),
+            ids[rows],
+            model["preprocessor"],
+            None if xp_err is None else xp_err[rows],
+            None if xp_corr is None else xp_corr[rows],
+        )
+        coords[rows] = reducer.transform(pxp)
+    return coords
+
+
+if __name__ == "__main__":
+    print("Loading data...")
+    fl = xs.load_store("../data/interim/xp_coeffs")
+    ids = np.asarray(fl["ids"])
+    # As in umap_tsne_xp, which saves its (fitted) preprocessor with the UMAP
+    if os.path.exists(UMAP_MODEL_FILE):
+        preprocessor = load_umap_model()["preprocessor"]
+    else:
+        import umap_tsne_xp as ut
+
+        print(f"No {UMAP_MODEL_FILE}; fitting umap_tsne_xp.PREPROCESSOR...")
+        preprocessor = "+".join(ut.PREPROCESSOR)
+    preprocessor, pxp = fit_preprocess(
+        fl["xp"], ids, preprocessor, fl["xp_err"], fl.get("xp_corr")
+    )
+
+    with np.load("../data/processed/tsne_xp.npz") as fl:
+        embedding = fl["embedding"][xs.select_rows({"ids": fl["ids"]}, ids)]
+
+    print("Building tSNE model...")
+    build_model(ids, pxp, embedding, preprocessor=preprocessor)
+    pr.write_report()
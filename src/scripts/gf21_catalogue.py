@@ -0,0 +1,75 @@
+"""
+gf21_catalogue.py
+=================
+Cached, binary copy of the GF+21 catalogue (`data/interim/gf21_filtered.csv`), for
+fast lookups by Gaia ID.
+The first time a .csv file is used, its numeric columns are saved as a store (see
+`xp_store.py`) next to it, sorted by Gaia ID, e.g. `data/interim/gf21_filtered/`.
+After that, no .csv parsing is needed: the store is opened once per process, and
+lookups are vectorised binary searches.
+The store is rebuilt automatically if the .csv file is newer.
+"""
+
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+
+import xp_store as xs
+
+GF21_FILE = "../data/interim/gf21_filtered.csv"
+ID_COLUMN = "GaiaEDR3"
+
+
+def build_catalogue(csv_file=GF21_FILE):
+    """
+    Converts the numeric columns of a GF+21 .csv file to a store, sorted by Gaia ID
+    """
+    print(f"Building catalogue from {csv_file}...")
+    table = pd.read_csv(csv_file).sort_values(ID_COLUMN)
+    columns = table.select_dtypes("number").drop(columns=ID_COLUMN)
+    xs.save_store(
+        os.path.splitext(csv_file)[0],
+        ids=table[ID_COLUMN].values.astype(np.int64),
+        **{col: columns[col].values for col in columns},
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def load_catalogue(csv_file=GF21_FILE):
+    """
+    Opens the store for a GF+21 .csv file (once per process), building it first if
+     it doesn't exist or is older than the .csv file.
+    """
+    store_path = os.path.splitext(csv_file)[0]
+    ids_file = os.path.join(store_path, "ids.npy")
+    if not os.path.exists(ids_file) or (
+        os.path.exists(csv_file)
+        and os.path.getmtime(ids_file) < os.path.getmtime(csv_file)
+    ):
+        build_catalogue(csv_file)
+    return xs.load_store(store_path)
+
+
+def catalogue_ids(csv_file=GF21_FILE):
+    "The (sorted) Gaia IDs in the catalogue"
+    return load_catalogue(csv_file)["ids"]
+
+
+def lookup(ids, columns, csv_file=GF21_FILE):
+    """
+    Looks up `columns` of the catalogue for the Gaia IDs `ids`, in the same order.
+    Returns an array if `columns` is a single column name, else a dict of arrays.
+    Raises a KeyError if any of the IDs isn't in the catalogue.
+    """
+    catalogue = load_catalogue(csv_file)
+    rows = xs.select_rows(catalogue, ids)
+    if isinstance(columns, str):
+        return np.asarray(catalogue[columns][rows])
+    return {col: np.asarray(catalogue[col][rows]) for col in columns}
+
+
+if __name__ == "__main__":
+    # (Re)builds the catalogue
+    build_catalogue()
@@ -5,17 +5,15 @@ Script to use DBSCAN to isolate the Gaia DR3 IDs of the polluted islands
 """
 
 import numpy as np
-from sklearn.cluster import DBSCAN
 
-fl = np.load("../data/processed/tsne_xp.npz")
-ids = fl["ids"]
-tsne_embedding = fl["embedding"]
+import tsne_clustering as tc
 
-dbscan = DBSCAN(eps=2, min_samples=30)
-dbscan.fit(tsne_embedding)
+clustering = tc.load_clustering()  # DBSCAN(eps=2, min_samples=30), cached
+ids = clustering["ids"]
+labels = clustering["labels"]
 
-cool_DZs = ids[dbscan.labels_ == 4]
-warm_DZs = ids[dbscan.labels_ == 6]
+cool_DZs = ids[labels == clustering["cool"]]
+warm_DZs = ids[labels == clustering["warm"]]
 
 np.savez_compressed(
     "../data/processed/polluted_islands.npz",
@@ -0,0 +1,356 @@
+"""
+pipeline.py
+===========
+Runs the pipeline, from the raw XP spectra to the figures, as a graph of stages.
+Each stage is a script (run with some arguments), with the files or directories
+it reads (`inputs`) and writes (`outputs`); a stage depends on the stages which
+write its inputs.
+A stage is skipped if its outputs exist and neither its script, its arguments, nor
+the contents of its inputs have changed since it last ran (as recorded in
+`data/interim/pipeline_state.json`). Existing outputs are adopted the first time
+the pipeline sees them (unless a stage they depend on has just run), and kept if
+their inputs aren't available.
+Stages whose dependencies are done run in parallel, across a pool of processes.
+Each worker runs scripts in-process, so modules and their caches (e.g. the GF+21
+catalogue, the pollution labels) are loaded once per worker, not once per script.
+"""
+
+import hashlib
+import json
+import os
+import runpy
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+STATE_FILE = "../data/interim/pipeline_state.json"
+XP_COEFFS = "../data/interim/xp_coeffs"
+XP_SAMPLED = "../data/interim/xp_sampled"
+GF21_FILE = "../data/interim/gf21_filtered.csv"
+GF21_CATALOGUE = "../data/interim/gf21_filtered"
+LABEL_SOURCES = [
+    "../data/external/evaluation/gf21_sdss.csv",
+    "../data/external/evaluation/mwdd.csv",
+    "../data/external/evaluation/pewdd.csv",
+]
+LABEL_TABLE = "../data/interim/pollution_labels.npz"
+TSNE_FILE = "../data/processed/tsne_xp.npz"
+UMAP_FILE = "../data/processed/umap_xp.npz"
+ISLANDS_FILE = "../data/processed/polluted_islands.npz"
+FRACTION_FILES = [
+    f"../data/processed/tsne_xp_polluted_islands_plus_fraction{fraction:.2f}.npz"
+    for fraction in [0, 0.04, 0.10, 0.25]
+]
+PREVIOUS_WORK = [
+    "../data/external/previous_work/garciazamora25.csv",
+    "../data/external/previous_work/vincent24.csv",
+    "../data/external/previous_work/secret/umap_polluted_all.csv",
+    "../data/processed/som_DZs.npz",
+]
+FIGURES_DIR = "../tex/figures"
+
+STAGES = {
+    "ingest": {
+        "script": "process_xp.py",
+        "inputs": ["../data/external/xp.csv"],
+        "outputs": [XP_COEFFS, XP_SAMPLED],
+    },
+    "catalogue": {
+        "script": "gf21_catalogue.py",
+        "inputs": [GF21_FILE],
+        "outputs": [GF21_CATALOGUE],
+    },
+    "labels": {
+        "script": "check_polluted.py",
+        "inputs": LABEL_SOURCES,
+        "outputs": [LABEL_TABLE],
+    },
+    "embed": {
+        "script": "umap_tsne_xp.py",
+        "inputs": [XP_COEFFS, GF21_CATALOGUE],
+        "outputs": [TSNE_FILE, UMAP_FILE],
+    },
+    "cluster": {
+        "script": "isolate_polluted_islands.py",
+        "inputs": [TSNE_FILE, LABEL_TABLE, GF21_CATALOGUE],
+        "outputs": [ISLANDS_FILE],
+    },
+    "divide": {
+        "script": "divide_polluted_islands.py",
+        "inputs": [XP_COEFFS, GF21_CATALOGUE, ISLANDS_FILE],
+        "outputs": FRACTION_FILES,
+    },
+    "fig1": {
+        "script": "create_fig_tsneembedding.py",
+        "args": [1],
+        "inputs": [TSNE_FILE, LABEL_TABLE],
+        "outputs": [f"{FIGURES_DIR}/fig1_tsneembedding.png"],
+    },
+    "fig2": {
+        "script": "create_fig_tsneclustering.py",
+        "args": [2],
+        "inputs": [TSNE_FILE, UMAP_FILE, LABEL_TABLE, GF21_CATALOGUE],
+        "outputs": [f"{FIGURES_DIR}/fig2_tsneclustering.png"],
+    },
+    "fig3": {
+        "script": "create_fig_coaddedspectrum.py",
+        "args": [3],
+        "inputs": [XP_SAMPLED, ISLANDS_FILE, LABEL_TABLE] + PREVIOUS_WORK,
+        "outputs": [f"{FIGURES_DIR}/fig3_coaddedspectrum.png"],
+    },
+    "fig4-6": {
+        "script": "create_fig_classes.py",
+        "args": [4, 5, 6],
+        "inputs": [TSNE_FILE, GF21_CATALOGUE, LABEL_SOURCES[0]],
+        "outputs": [
+            f"{FIGURES_DIR}/fig4_DAsequence.png",
+            f"{FIGURES_DIR}/fig5_DBCQ.png",
+            f"{FIGURES_DIR}/fig6_ms.png",
+        ],
+    },
+    "fig7": {
+        "script": "create_fig_upset.py",
+        "args": [7],
+        "inputs": [ISLANDS_FILE, LABEL_TABLE] + PREVIOUS_WORK,
+        "outputs": [f"{FIGURES_DIR}/fig7_upset.png"],
+    },
+    "fig8": {
+        "script": "create_fig_whytwoislands.py",
+        "args": [8],
+        "inputs": [ISLANDS_FILE] + FRACTION_FILES,
+        "outputs": [f"{FIGURES_DIR}/fig8_whytwoislands.png"],
+    },
+    "fig9": {
+        "script": "create_fig_clustercomparison.py",
+        "args": [9],
+        "inputs": [ISLANDS_FILE, "../data/interim/gf21_filtered_moredata.csv"],
+        "outputs": [f"{FIGURES_DIR}/fig9_clustercomparison.png"],
+    },
+}
+FIGURE_STAGES = [name for name in STAGES if name.startswith("fig")]
+
+
+# --------------------------
+# Content hashes
+
+
+def hash_file(path, file_hashes):
+    """
+    sha1 of a file's contents, remembered in `file_hashes` by its size and mtime,
+     so unchanged files are only read once
+    """
+    stat = os.stat(path)
+    stamp = f"{stat.st_size}:{stat.st_mtime_ns}"
+    if file_hashes.get(path, {}).get("stamp") != stamp:
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                sha.update(block)
+        file_hashes[path] = {"stamp": stamp, "sha1": sha.hexdigest()}
+    return file_hashes[path]["sha1"]
+
+
+def hash_path(path, file_hashes):
+    "Content hash of a file, or of every file in a directory"
+    if not os.path.isdir(path):
+        return hash_file(path, file_hashes)
+    sha = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(path)):
+        dirs.sort()
+        for fname in sorted(files):
+            fpath = os.path.join(root, fname)
+            sha.update(os.path.relpath(fpath, path).encode())
+            sha.update(hash_file(fpath, file_hashes).encode())
+    return sha.hexdigest()
+
+
+def stage_key(stage, file_hashes):
+    """
+    Content hash of a stage's script, arguments and inputs.
+    None if any of the inputs don't exist.
+    """
+    if not all(os.path.exists(path) for path in stage["inputs"]):
+        return None
+    sha = hashlib.sha1()
+    sha.update(hash_file(stage["script"], file_hashes).encode())
+    sha.update(json.dumps(stage.get("args", [])).encode())
+    for path in stage["inputs"]:
+        sha.update(hash_path(path, file_hashes).encode())
+    return sha.hexdigest()
+
+
+def load_state(path=STATE_FILE):
+    "The key each stage last ran with, and the remembered file hashes"
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"stages": {}, "files": {}}
+
+
+def save_state(state, path=STATE_FILE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+# --------------------------
+# Running stages
+
+
+def dependencies(stages=STAGES):
+    "The stages each stage depends on, i.e. those which write its inputs"
+    producers = {path: name for name, s in stages.items() for path in s["outputs"]}
+    return {
+        name: sorted({producers[path] for path in s["inputs"] if path in producers})
+        for name, s in stages.items()
+    }
+
+
+def upstream(targets, deps):
+    "The `targets` and all the stages they depend on, directly or indirectly"
+    needed = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(deps[name])
+    return needed
+
+
+def init_worker():
+    "Uses a non-interactive matplotlib backend, as figures are only saved"
+    os.environ["MPLBACKEND"] = "Agg"
+
+
+def run_stage(script, args=()):
+    """
+    Runs a script in this (worker) process, as if from the command line.
+    A `sys.exit` with a non-zero status raises a RuntimeError.
+    """
+    sys.argv = [script] + [str(arg) for arg in args]
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as err:
+        if err.code not in (None, 0):
+            raise RuntimeError(f"{script} exited with status {err.code}") from None
+    finally:
+        if "profiling" in sys.modules:  # One report per stage, not per worker
+            sys.modules["profiling"].write_report(os.path.splitext(script)[0])
+        if "matplotlib.pyplot" in sys.modules:
+            sys.modules["matplotlib.pyplot"].close("all")
+
+
+def is_up_to_date(name, key, state, upstream_ran=False):
+    """
+    Whether a stage can be skipped: its outputs exist, and it last ran with the same
+     key, or hasn't been run by the pipeline yet (so its outputs are adopted), or
+     its inputs aren't available (`key` is None) to run it again.
+    If `upstream_ran` (a stage it depends on ran in this run), only a recorded
+     matching key will do, as existing outputs were made from the old inputs.
+    """
+    stage = STAGES[name]
+    if not all(os.path.exists(path) for path in stage["outputs"]):
+        return False
+    last_key = state["stages"].get(name)
+    if upstream_ran:
+        return key is not None and last_key == key
+    return key is None or last_key is None or last_key == key
+
+
+def report_upstream(targets, deps, state):
+    """
+    Prints the stages which `targets` depend on (directly or not) whose outputs are
+     missing, or out of date (they've run, but their script or inputs have changed
+     since), without running them
+    """
+    needed = upstream(targets, deps) - set(targets)
+    for name in [name for name in STAGES if name in needed]:
+        if not all(os.path.exists(path) for path in STAGES[name]["outputs"]):
+            print(f"[{name}] outputs missing; run `python pipeline.py {name}`")
+            continue
+        key = stage_key(STAGES[name], state["files"])
+        last_key = state["stages"].get(name)
+        if key is not None and last_key is not None and key != last_key:
+            print(f"[{name}] out of date; run `python pipeline.py {name}` to update")
+
+
+def run(targets=None, n_workers=None, force=False, only=False):
+    """
+    Runs the stages needed for `targets` (default: all), skipping those which are
+     up to date (unless `force`), across `n_workers` processes (default: all cores).
+    If `only`, just the `targets` are run, not the stages they depend on; those
+     with missing or out of date outputs are reported (see `report_upstream`).
+    Stages which depend on a failed stage aren't run.
+    Raises a RuntimeError at the end if any stages failed.
+    """
+    deps = dependencies()
+    state = load_state()
+    if only:
+        needed = set(targets or STAGES)
+        report_upstream(needed, deps, state)
+    else:
+        needed = upstream(targets or list(STAGES), deps)
+    done, failed, ran, running = set(), set(), set(), {}
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker) as pool:
+        while True:
+            ready = [
+                name
+                for name in STAGES
+                if name in needed
+                and name not in done | failed | set(running.values())
+                and all(dep in done or dep not in needed for dep in deps[name])
+            ]
+            for name in ready:
+                key = stage_key(STAGES[name], state["files"])
+                upstream_ran = any(dep in ran for dep in deps[name])
+                if not force and is_up_to_date(name, key, state, upstream_ran):
+                    print(f"[{name}] up to date")
+                    if key is not None:
+                        state["stages"][name] = key
+                    done.add(name)
+                    continue
+                if key is None:
+                    print(f"[{name}] failed: missing inputs")
+                    failed.add(name)
+                    continue
+                print(f"[{name}] running {STAGES[name]['script']}...")
+                stage = STAGES[name]
+                future = pool.submit(run_stage, stage["script"], stage.get("args", []))
+                running[future] = name
+
+            for name in STAGES:  # In order, so failures propagate all the way down
+                if name not in needed or name in done | failed:
+                    continue
+                if any(dep in failed for dep in deps[name]):
+                    print(f"[{name}] skipped: a dependency failed")
+                    failed.add(name)
+
+            if not running:
+                if ready:  # Skipped stages may have unblocked others
+                    continue
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except BaseException as err:  # Including a stage's SystemExit
+                    print(f"[{name}] failed: {err!r}")
+                    failed.add(name)
+                    continue
+                print(f"[{name}] done")
+                state["stages"][name] = stage_key(STAGES[name], state["files"])
+                done.add(name)
+                ran.add(name)
+            save_state(state)
+
+    save_state(state)
+    if failed:
+        raise RuntimeError(f"Stages failed: {', '.join(sorted(failed))}")
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:] or None)
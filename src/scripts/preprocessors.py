@@ -2,46 +2,411 @@
 preprocessors.py
 ================
 Functions for preprocessing the raw Gaia XP data.
+Each normalisation divides every source's coefficients by a scale (its G-band flux,
+or a statistic of its coefficients). The functions keep the dtype of their input
+(e.g. float32), and can work in place with `out=`.
+Normalisations can also be chained (see `chain`), with fit/transform semantics:
+`fit_chain` looks up anything the chain needs for a set of sources (their G-band
+fluxes) once, and `transform` applies it chunk by chunk, e.g. straight from a
+memory-mapped store, into a single output array (or in place), without full-size
+temporaries.
+Chains can also error-weight the coefficients, using their errors (`xp_err`), and
+optionally their correlations (`xp_corr`), from `process_xp.py`: each coefficient
+is shrunk towards the sample mean by the fraction of its variance which is signal
+rather than noise (a Wiener filter), so that the noisy (e.g. high-order)
+coefficients of faint sources count for less in the distances between sources.
+The signal (co)variance of the sample is found by `fit_chain`.
 """
 
 import numpy as np
-import pandas as pd
 
+import gf21_catalogue as gf
+import profiling as pr
 
-def divide_Gflux(xp_coeffs, ids):
+# The Gaia G zeropoint for AB mags. This offset is arbitrary, but ensures
+# coefficient values are not too big/small: log(coeff) ~ -4 +/- 1
+# Doesn't affect relative proximities of points, just makes numerics more stable
+G_ZEROPOINT = 25.7934
+CHUNK_SIZE = 100_000  # Rows transformed at a time by `transform`
+COV_CHUNK_SIZE = 2_000  # Rows at a time with full covariances (~50 kB each)
+SIGNAL_FLOOR = 1e-3  # Minimum signal variance, relative to the total (or largest)
+MISSING_ERR = 1e3  # Error of missing coefficients, relative to the signal's spread
+
+
+def Gflux(ids):
     """
-    Normalises the coefficients by the flux in the G band, found from GF+21
+    The flux in the G band of the sources `ids`, from GF+21
+    """
+    Gmag = gf.lookup(ids, "Gmag")
+    return 10 ** (-0.4 * (Gmag - G_ZEROPOINT))
+
+
+def float_dtype(xp_coeffs):
+    "The dtype of `xp_coeffs` if it's floating point, else float64"
+    return xp_coeffs.dtype if xp_coeffs.dtype.kind == "f" else np.dtype(np.float64)
+
+
+def divide_rows(xp_coeffs, scale, out=None):
     """
-    gf21 = pd.read_csv("../data/interim/gf21_filtered.csv")
-    gf21.set_index("GaiaEDR3", inplace=True)
+    Divides each row of `xp_coeffs` by `scale`, keeping the dtype of `xp_coeffs`
+     (if it's floating point), into `out` if given (which may be `xp_coeffs`)
+    """
+    xp_coeffs = np.asarray(xp_coeffs)
+    scale = np.asarray(scale, dtype=float_dtype(xp_coeffs))
+    return np.divide(xp_coeffs, scale[:, None], out=out)
 
-    Gmag = gf21.loc[ids, "Gmag"].values
-    Gflux = 10 ** (-0.4 * (Gmag - 25.7934))
-    # This offset is arbitrary  ^^^^^^^^^
-    # It's the Gaia G zeropoint for AB mags, and ensures
-    # coefficient values are not too big/small: log(coeff) ~ -4 +/- 1
-    # Doesn't affect relative proximities of points,
-    # just makes numerics more stable
 
-    return xp_coeffs / Gflux[:, None]
+@pr.profiled()
+def divide_Gflux(xp_coeffs, ids, out=None):
+    """
+    Normalises the coefficients by the flux in the G band, found from GF+21
+    """
+    return divide_rows(xp_coeffs, Gflux(ids), out)
 
 
-def l2_norm(xp_coeffs):
+def l2_norm(xp_coeffs, out=None):
     """
     Normalises the coefficients by the L2 norm
     """
-    return xp_coeffs / np.linalg.norm(xp_coeffs, axis=1)[:, None]
+    return divide_rows(xp_coeffs, np.linalg.norm(xp_coeffs, axis=1), out)
 
 
-def divide_median(xp_coeffs):
+def divide_median(xp_coeffs, out=None):
     """
     Normalises the coefficients by the median value of each coefficient
     """
-    return xp_coeffs / np.median(xp_coeffs, axis=1)[:, None]
+    return divide_rows(xp_coeffs, np.median(xp_coeffs, axis=1), out)
 
 
-def divide_mean(xp_coeffs):
+def divide_mean(xp_coeffs, out=None):
     """
     Normalises the coefficients by the mean value of each coefficient
     """
-    return xp_coeffs / np.mean(xp_coeffs, axis=1)[:, None]
+    return divide_rows(xp_coeffs, np.mean(xp_coeffs, axis=1), out)
+
+
+def error_weight(xp_coeffs, xp_err, mean, signal_var, out=None):
+    """
+    Error-weights the coefficients, with their errors `xp_err` (in the same units):
+     shrinks each towards the sample `mean`, by signal_var / (signal_var + xp_err^2),
+     where `signal_var` is the variance of that coefficient across the sample
+     which isn't noise (see `error_stats`).
+    Missing coefficients are set to the mean.
+    Keeps the dtype of `xp_coeffs`, into `out` if given (which may be `xp_coeffs`).
+    """
+    xp_coeffs = np.asarray(xp_coeffs)
+    noise_var = np.nan_to_num(np.asarray(xp_err, dtype=np.float64) ** 2, nan=np.inf)
+    weight = signal_var / (signal_var + noise_var)
+    weighted = mean + weight * np.nan_to_num(xp_coeffs - mean)
+    if out is None:
+        out = np.empty(weighted.shape, dtype=float_dtype(xp_coeffs))
+    out[...] = weighted
+    return out
+
+
+def error_weight_cov(xp_coeffs, xp_err, xp_corr, mean, signal_cov, out=None):
+    """
+    As `error_weight`, with the full covariance matrix C of each source's
+     coefficients, from their errors and packed correlations (see
+     `process_xp.covariance_matrices`). For each band, with the sample's signal
+     covariance S (see `error_stats`):
+        x -> mean + S (S + C)^-1 (x - mean),
+     solved for all the sources at once.
+    Needs ~50 kB per source, so should be applied in chunks (see `transform`).
+    """
+    xp_coeffs = np.asarray(xp_coeffs)
+    n_rows, n_coeffs = xp_coeffs.shape
+    shape = (n_rows, 2, n_coeffs // 2)
+    band_mean = np.asarray(mean).reshape(2, -1)
+    deviation = np.nan_to_num(xp_coeffs.reshape(shape) - band_mean)
+
+    signal_std = np.sqrt(np.diagonal(signal_cov, axis1=1, axis2=2))
+    errs = np.asarray(xp_err, dtype=np.float64).reshape(shape)
+    errs = np.where(np.isnan(errs), MISSING_ERR * signal_std, errs)
+    noise_cov = noise_covariances(errs, xp_corr)
+
+    solved = np.linalg.solve(signal_cov + noise_cov, deviation[..., None])
+    weighted = (band_mean + (signal_cov @ solved)[..., 0]).reshape(n_rows, n_coeffs)
+    if out is None:
+        out = np.empty(weighted.shape, dtype=float_dtype(xp_coeffs))
+    out[...] = weighted
+    return out
+
+
+# --------------------------
+# Chains of normalisations
+
+ROW_SCALES = {
+    "l2_norm": lambda xp: np.linalg.norm(xp, axis=1),
+    "divide_median": lambda xp: np.median(xp, axis=1),
+    "divide_mean": lambda xp: np.mean(xp, axis=1),
+}
+ERROR_STEPS = ["error_weight", "error_weight_cov"]
+STEPS = ["divide_Gflux"] + list(ROW_SCALES) + ERROR_STEPS
+
+
+def chain(*steps, dtype=np.float64):
+    """
+    A chain of normalisations, applied in turn: any of `STEPS` (the names of the
+     functions above), e.g. chain("divide_Gflux", "l2_norm"), or
+     chain("divide_Gflux", "error_weight"). The output is `dtype`, which is also
+     used for all the intermediate steps: float64 by default, as the published
+     embeddings were made with; float32 halves the memory and time, but changes
+     the embeddings slightly.
+    The errors are scaled along with the coefficients, so error-weighting steps can
+     come after any others.
+    A chain is a dict, so it can be saved alongside a model (see `fit_chain`).
+    """
+    steps = list(steps) or ["divide_Gflux"]
+    unknown = [step for step in steps if step not in STEPS]
+    if unknown:
+        raise ValueError(f"Unknown steps {unknown}; must be in {STEPS}")
+    return {"steps": steps, "dtype": np.dtype(dtype).name}
+
+
+def fit_chain(
+    chain, ids, xp_coeffs=None, xp_err=None, xp_corr=None, chunk_size=CHUNK_SIZE
+):
+    """
+    Fits a chain to the sources `ids`: looks up the G-band fluxes it needs once, so
+     `transform` doesn't need the GF+21 catalogue for these sources again.
+    Error-weighting steps are fitted to the sources' coefficients `xp_coeffs` and
+     errors `xp_err` (and correlations `xp_corr`, for "error_weight_cov"), as they
+     are at that step (see `error_stats`).
+    Returns the fitted chain (a new dict).
+    """
+    fitted = dict(chain)
+    if "divide_Gflux" in chain["steps"]:
+        fitted["ids"] = np.unique(np.asarray(ids))
+        fitted["Gflux"] = Gflux(fitted["ids"])
+    fitted["stats"] = {}
+    for i, step in enumerate(chain["steps"]):
+        if step in ERROR_STEPS:
+            if xp_coeffs is None:
+                raise ValueError("The coefficients are needed to fit error weighting")
+            fitted["stats"][i] = error_stats(
+                fitted, i, xp_coeffs, ids, xp_err, xp_corr, chunk_size
+            )
+    return fitted
+
+
+def error_stats(
+    chain, n_steps, xp_coeffs, ids, xp_err, xp_corr=None, chunk_size=CHUNK_SIZE
+):
+    """
+    The statistics of the sample needed by an error-weighting step, after the first
+     `n_steps` steps of the chain. Returns a dict of:
+    - mean: the mean of each coefficient
+    - signal_var (for "error_weight"): the variance of each coefficient, minus the
+      mean variance of its noise
+    - signal_cov (for "error_weight_cov"): the covariance matrix of the
+      coefficients in each band (2, 55, 55), minus the mean covariance of their
+      noise, using only the sources with all of their coefficients
+    The signal (co)variances are floored at `SIGNAL_FLOOR` of the total variance
+     (or, for covariances, of the largest eigenvalue), as the noise can exceed the
+     spread of the sample where there's little signal.
+    """
+    use_cov = chain["steps"][n_steps] == "error_weight_cov"
+    if use_cov:
+        chunk_size = min(chunk_size, COV_CHUNK_SIZE)
+    sums = {}
+    for rows, block, errs in preprocess_chunks(
+        chain,
+        xp_coeffs,
+        ids,
+        chunk_size,
+        xp_err=xp_err,
+        xp_corr=xp_corr,
+        n_steps=n_steps,
+        with_errs=True,
+    ):
+        block = block.astype(np.float64)
+        if use_cov:
+            is_complete = np.all(np.isfinite(block) & np.isfinite(errs), axis=1)
+            block, errs = block[is_complete], errs[is_complete]
+            noise = noise_covariances(errs, np.asarray(xp_corr[rows])[is_complete])
+            bands = block.reshape(len(block), 2, -1)
+            chunk_sums = {
+                "n": len(block),
+                "x": bands.sum(axis=0),
+                "xx": np.einsum("nbi,nbj->bij", bands, bands),
+                "noise": noise.sum(axis=0),
+            }
+        else:
+            is_finite = np.isfinite(block) & np.isfinite(errs)
+            block, errs = np.where(is_finite, block, 0), np.where(is_finite, errs, 0)
+            chunk_sums = {
+                "n": is_finite.sum(axis=0),
+                "x": block.sum(axis=0),
+                "xx": (block**2).sum(axis=0),
+                "noise": (errs**2).sum(axis=0),
+            }
+        for key, value in chunk_sums.items():
+            sums[key] = sums.get(key, 0) + value
+
+    n = sums["n"] if use_cov else np.maximum(sums["n"], 1)
+    mean = sums["x"] / n
+    if not use_cov:
+        total_var = sums["xx"] / n - mean**2
+        signal_var = np.maximum(total_var - sums["noise"] / n, SIGNAL_FLOOR * total_var)
+        return {"mean": mean, "signal_var": signal_var}
+
+    total_cov = sums["xx"] / n - mean[:, :, None] * mean[:, None, :]
+    eigvals, eigvecs = np.linalg.eigh(total_cov - sums["noise"] / n)
+    eigvals = np.maximum(eigvals, SIGNAL_FLOOR * eigvals.max(axis=1, keepdims=True))
+    signal_cov = (eigvecs * eigvals[:, None, :]) @ eigvecs.transpose(0, 2, 1)
+    return {"mean": mean.ravel(), "signal_cov": signal_cov}
+
+
+def noise_covariances(errs, xp_corr):
+    """
+    The covariance matrices (n, 2, 55, 55) of coefficients with errors `errs` and
+     packed correlations `xp_corr`, as `process_xp.covariance_matrices`
+    """
+    from process_xp import correlation_matrices  # Only needed here
+
+    errs = np.asarray(errs).reshape(len(errs), 2, -1)
+    return errs[..., :, None] * correlation_matrices(xp_corr) * errs[..., None, :]
+
+
+def chain_Gflux(chain, ids):
+    "The G-band fluxes of `ids`, from the fitted chain where it has them"
+    if "ids" not in chain:
+        return Gflux(ids)
+    ids = np.asarray(ids)
+    pos = np.searchsorted(chain["ids"], ids).clip(max=len(chain["ids"]) - 1)
+    found = chain["ids"][pos] == ids
+    fluxes = np.empty(len(ids))
+    fluxes[found] = chain["Gflux"][pos[found]]
+    if not np.all(found):
+        fluxes[~found] = Gflux(ids[~found])
+    return fluxes
+
+
+def preprocess_chunks(
+    chain,
+    xp_coeffs,
+    ids=None,
+    chunk_size=CHUNK_SIZE,
+    out=None,
+    xp_err=None,
+    xp_corr=None,
+    n_steps=None,
+    with_errs=False,
+):
+    """
+    Applies the first `n_steps` steps of the chain (default: all) `chunk_size` rows
+     at a time, reading only those rows of `xp_coeffs` (and `xp_err`, `xp_corr`;
+     e.g. memmaps) at once.
+    Yields (rows, block, errs) for each chunk: the preprocessed chunk, as a view of
+     `out` if given (which may be `xp_coeffs`, to work in place), and its errors,
+     scaled along with it (float64; None unless the steps applied need them, or
+     `with_errs`, e.g. to fit a later error-weighting step).
+    Each chunk is processed in the chain's dtype, even if `out` has another (it's
+     then copied into `out`), so the results don't depend on where they go.
+    """
+    steps = chain["steps"][:n_steps]
+    if "divide_Gflux" in steps and ids is None:
+        raise ValueError("The IDs are needed to divide by G flux")
+    needs_errs = with_errs or any(step in ERROR_STEPS for step in steps)
+    if needs_errs and xp_err is None:
+        raise ValueError("The errors (xp_err) are needed for error weighting")
+    if "error_weight_cov" in steps:
+        if xp_corr is None:
+            raise ValueError("The correlations (xp_corr) are needed for covariances")
+        chunk_size = min(chunk_size, COV_CHUNK_SIZE)
+    error_steps = [i for i, step in enumerate(steps) if step in ERROR_STEPS]
+    if any(i not in chain.get("stats", {}) for i in error_steps):
+        raise ValueError("Error weighting needs the chain to be fitted (fit_chain)")
+
+    dtype = np.dtype(chain["dtype"])
+    n_rows = len(xp_coeffs)
+    for start in range(0, n_rows, chunk_size):
+        rows = slice(start, min(start + chunk_size, n_rows))
+        if out is not None and out.dtype == dtype:
+            block = out[rows]
+            block[...] = xp_coeffs[rows]
+        else:
+            block = np.asarray(xp_coeffs[rows], dtype=dtype)
+            if np.may_share_memory(block, xp_coeffs):  # Don't modify the input
+                block = block.copy()
+        errs = np.array(xp_err[rows], dtype=np.float64) if needs_errs else None
+
+        for i, step in enumerate(steps):
+            if step == "error_weight":
+                error_weight(block, errs, **chain["stats"][i], out=block)
+                continue
+            if step == "error_weight_cov":
+                stats = chain["stats"][i]
+                error_weight_cov(block, errs, xp_corr[rows], **stats, out=block)
+                continue
+            if step == "divide_Gflux":
+                scale = chain_Gflux(chain, np.asarray(ids[rows]))
+            else:
+                scale = ROW_SCALES[step](block)
+            divide_rows(block, scale, out=block)
+            if errs is not None:
+                divide_rows(errs, scale, out=errs)
+        if out is not None and out.dtype != dtype:
+            out[rows] = block
+            block = out[rows]
+        yield rows, block, errs
+
+
+def transform_chunks(
+    chain,
+    xp_coeffs,
+    ids=None,
+    chunk_size=CHUNK_SIZE,
+    out=None,
+    xp_err=None,
+    xp_corr=None,
+):
+    """
+    Applies the chain `chunk_size` rows at a time, reading only those rows of
+     `xp_coeffs` (e.g. a memmap) at once.
+    Yields (rows, block) for each chunk, where `block` is the preprocessed chunk, as
+     a view of `out` if given (which may be `xp_coeffs`, to work in place).
+    `ids` are needed if the chain divides by G flux, and `xp_err` (and `xp_corr`)
+     if it error-weights.
+    """
+    for rows, block, _ in preprocess_chunks(
+        chain, xp_coeffs, ids, chunk_size, out, xp_err, xp_corr
+    ):
+        yield rows, block
+
+
+@pr.profiled(rows=len)
+def transform(
+    chain,
+    xp_coeffs,
+    ids=None,
+    out=None,
+    chunk_size=CHUNK_SIZE,
+    xp_err=None,
+    xp_corr=None,
+):
+    """
+    Applies the chain to `xp_coeffs` (see `transform_chunks`), into `out` if given
+     (e.g. `xp_coeffs` itself, or a disk-backed memmap), else a new array of the
+     chain's dtype.
+    """
+    if out is None:
+        out = np.empty(np.shape(xp_coeffs), dtype=chain["dtype"])
+    for _ in preprocess_chunks(chain, xp_coeffs, ids, chunk_size, out, xp_err, xp_corr):
+        pass
+    return out
+
+
+def fit_transform(
+    chain,
+    xp_coeffs,
+    ids,
+    out=None,
+    chunk_size=CHUNK_SIZE,
+    xp_err=None,
+    xp_corr=None,
+):
+    "Fits the chain to `ids` and applies it. Returns the fitted chain and the output."
+    fitted = fit_chain(chain, ids, xp_coeffs, xp_err, xp_corr, chunk_size)
+    return fitted, transform(fitted, xp_coeffs, ids, out, chunk_size, xp_err, xp_corr)
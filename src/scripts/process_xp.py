@@ -1,66 +1,425 @@
 """
 process_xp.py
 =============
-This script processes the raw Gaia XP data, creating the file
-`data/interim/xp_coeffs.npz`. This file contains:
+This script processes the raw Gaia XP data, creating the store
+`data/interim/xp_coeffs/` (see `xp_store.py`). This contains:
 - `ids` -- the Gaia EDR3 IDs
 - `xp` -- the XP coefficients
 - `xp_err` -- the errors on the XP coefficients
+- `xp_corr` -- the correlations between the XP coefficients, packed (see below)
 """
 
-from ast import literal_eval
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
 import numpy as np
 import pandas as pd
+from gaiaxpy import __version__ as gaiaxpy_version
 from gaiaxpy import calibrate
 
+import profiling as pr
+import xp_store as xs
+
+N_COEFFS = 55  # Number of coefficients per band (BP, RP)
+COEFF_COLUMNS = ["bp_coefficients", "rp_coefficients"]
+ERR_COLUMNS = ["bp_coefficient_errors", "rp_coefficient_errors"]
+CORR_COLUMNS = ["bp_coefficient_correlations", "rp_coefficient_correlations"]
+N_CORRS = N_COEFFS * (N_COEFFS - 1) // 2  # 1485 off-diagonal correlations per band
+CHUNKSIZE = 10_000  # Rows per chunk when streaming the .csv file
+SWAP_MARKER = "complete"  # Marks a merged store as ready to be swapped in
+COV_BATCH_SIZE = 250  # Rows sampled at a time with full covariances (~0.1 GB)
+
+
+def count_rows(filename):
+    """
+    Counts the data rows in a .csv file (excluding the header) without parsing it
+    """
+    n_lines = 0
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            n_lines += block.count(b"\n")
+            last_byte = block[-1:]
+    if n_lines and last_byte != b"\n":  # No trailing newline
+        n_lines += 1
+    return max(n_lines - 1, 0)
+
+
+def allocate_array(shape, out_dir=None, name=None, dtype=np.float64):
+    """
+    Allocates an array to be filled chunk by chunk.
+    If `out_dir` is given, the array is a disk-backed .npy memmap `out_dir/name.npy`
+    """
+    if out_dir is None:
+        return np.empty(shape, dtype=dtype)
+    os.makedirs(out_dir, exist_ok=True)
+    return np.lib.format.open_memmap(
+        os.path.join(out_dir, f"{name}.npy"), mode="w+", dtype=dtype, shape=shape
+    )
+
+
+def truncate_array(arr, n_rows, block_size=CHUNKSIZE):
+    """
+    The first `n_rows` rows of `arr`. A disk-backed memmap (from `allocate_array`)
+     is rewritten to a file of that many rows, block by block.
+    """
+    if not isinstance(arr, np.memmap) or arr.filename is None:
+        return arr[:n_rows]
+    path = arr.filename
+    truncated = np.lib.format.open_memmap(
+        f"{path}.tmp", mode="w+", dtype=arr.dtype, shape=(n_rows,) + arr.shape[1:]
+    )
+    for start in range(0, n_rows, block_size):
+        block = slice(start, min(start + block_size, n_rows))
+        truncated[block] = arr[block]
+    truncated.flush()
+    del truncated, arr
+    os.replace(f"{path}.tmp", path)
+    return np.load(path, mmap_mode="r+")
+
+
+def parse_coefficients(column, n_coeffs=N_COEFFS):
+    """
+    Parses a column of bracketed coefficient strings, e.g. "(a, b, c, ...)" or
+     "[a, b, c, ...]", to a (n_rows, n_coeffs) array in a single pass.
+    The brackets are stripped and the whole column joined into one buffer, which
+     numpy parses in C, instead of building an AST for each row.
+    Null rows, and rows shorter than `n_coeffs` (e.g. `bp_n_parameters` < 55), are
+     padded with NaNs.
+    """
+    strings = pd.Series(column).fillna("").astype(str).str.strip("()[] \t")
+    n_rows = len(strings)
+
+    values = np.fromstring(",".join(strings[strings != ""]), sep=",")
+    lengths = np.where(strings != "", strings.str.count(",").values + 1, 0)
+    if lengths.max(initial=0) > n_coeffs:
+        raise ValueError(f"Found a row with more than {n_coeffs} coefficients")
+    if len(values) != lengths.sum():
+        raise ValueError("Couldn't parse all of the coefficients in the column")
 
-def read_xp_to_arrays(filename):
+    if np.all(lengths == n_coeffs):  # Fast path: every row is complete
+        return values.reshape(n_rows, n_coeffs)
+
+    coeffs = np.full((n_rows, n_coeffs), np.nan)
+    row_idx = np.repeat(np.arange(n_rows), lengths)
+    col_idx = np.arange(len(values)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    coeffs[row_idx, col_idx] = values
+    return coeffs
+
+
+@pr.profiled(rows=lambda result: len(result[0]))
+def read_xp_to_arrays(filename, chunksize=None, out_dir=None, correlations=False):
     """
     Converts a .csv file containing XP coefficients (and errors) to numpy arrays
-    Doesn't return the correlations between the coefficients (yet..?)
+    If `chunksize` is given, the file is streamed in chunks of that many rows, each
+     written straight into preallocated arrays, so peak memory doesn't grow with
+     the size of the file.
+    If `out_dir` is given, the arrays are disk-backed .npy memmaps in that directory
+     (`ids.npy`, `xp.npy`, `xp_err.npy`), and memory use is bounded by `chunksize`.
+    If `correlations` is True, the correlations between the coefficients are also
+     read, as they come from Gaia: the strict upper triangle of each band's
+     correlation matrix, packed column by column. These are stored as float32 to
+     save space; see `covariance_matrices` to unpack them.
     Returns:
     - gaia_ids: The Gaia EDR3 IDs (N,)
     - xp_coeffs: The XP coefficients (N, 110)
     - xp_errs: The errors on the XP coefficients (N, 110)
+    - xp_corrs: The packed correlations (N, 2, 1485), if `correlations` is True
     """
 
+    print("Counting rows...")
+    n_rows = count_rows(filename)
+    arrays = allocate_xp_arrays(n_rows, out_dir, correlations)
+
     print("Reading table...")
-    xp_spectra_table = pd.read_csv(filename)  # ~1min
+    usecols = xp_columns(correlations)
+    if chunksize is None:
+        chunks = [pd.read_csv(filename, usecols=usecols)]
+    else:
+        chunks = pd.read_csv(filename, usecols=usecols, chunksize=chunksize)
 
-    print("Extracting data...")
-    gaia_ids = np.array(xp_spectra_table["source_id"])
+    start = 0
+    for chunk in chunks:
+        print(f"Extracting data from rows {start}-{start + len(chunk)} of {n_rows}...")
+        extract_chunk(chunk, arrays, start)
+        start += len(chunk)
 
-    bp_coeffs = np.array(
-        [literal_eval(coeffs) for coeffs in xp_spectra_table["bp_coefficients"]]
-    )  # ~10s
-    rp_coeffs = np.array(
-        [literal_eval(coeffs) for coeffs in xp_spectra_table["rp_coefficients"]]
-    )
-    xp_coeffs = np.concatenate((bp_coeffs, rp_coeffs), axis=1)
+    if start != n_rows:  # Blank lines, or newlines within quoted fields
+        print(f"Read {start} rows, not the {n_rows} lines counted; truncating...")
+        arrays = {name: truncate_array(arr, start) for name, arr in arrays.items()}
+
+    if out_dir is not None:
+        for arr in arrays.values():
+            arr.flush()
+
+    return tuple(arrays.values())
 
-    bp_errs = np.array(
-        [literal_eval(errs) for errs in xp_spectra_table["bp_coefficient_errors"]]
+
+def xp_columns(correlations=False):
+    "The columns of the .csv file needed by `read_xp_to_arrays`"
+    usecols = ["source_id"] + COEFF_COLUMNS + ERR_COLUMNS
+    if correlations:
+        usecols += CORR_COLUMNS
+    return usecols
+
+
+def allocate_xp_arrays(n_rows, out_dir=None, correlations=False):
+    "Allocates the arrays filled by `extract_chunk` (see `allocate_array`)"
+    arrays = {
+        "ids": allocate_array((n_rows,), out_dir, "ids", dtype=np.int64),
+        "xp": allocate_array((n_rows, 2 * N_COEFFS), out_dir, "xp"),
+        "xp_err": allocate_array((n_rows, 2 * N_COEFFS), out_dir, "xp_err"),
+    }
+    if correlations:
+        arrays["xp_corr"] = allocate_array(
+            (n_rows, 2, N_CORRS), out_dir, "xp_corr", dtype=np.float32
+        )
+    return arrays
+
+
+def extract_chunk(chunk, arrays, start=0):
+    """
+    Parses a chunk of rows of the .csv file into `arrays` (from
+     `allocate_xp_arrays`), starting at row `start`
+    """
+    stop = start + len(chunk)
+    arrays["ids"][start:stop] = chunk["source_id"].values
+    for i, (coeff_col, err_col) in enumerate(zip(COEFF_COLUMNS, ERR_COLUMNS)):
+        band = slice(i * N_COEFFS, (i + 1) * N_COEFFS)
+        arrays["xp"][start:stop, band] = parse_coefficients(chunk[coeff_col])
+        arrays["xp_err"][start:stop, band] = parse_coefficients(chunk[err_col])
+    if "xp_corr" in arrays:
+        for i, corr_col in enumerate(CORR_COLUMNS):
+            # Packed column-major, so a short row's correlations are a prefix
+            arrays["xp_corr"][start:stop, i] = parse_coefficients(
+                chunk[corr_col], N_CORRS
+            )
+
+
+def row_hashes(chunk):
+    """
+    Content hashes of the rows of a chunk of the .csv file (uint64), of the columns
+     cast to fixed dtypes (int64 IDs, and strings, "" if empty), so an unchanged row
+     has the same hash whatever dtypes pandas infers for its chunk (e.g. float for
+     a column which is empty throughout the chunk)
+    """
+    fixed = pd.DataFrame(
+        {
+            col: (
+                chunk[col].astype(np.int64)
+                if col == "source_id"
+                else chunk[col].fillna("").astype(str)
+            )
+            for col in chunk.columns
+        }
     )
-    rp_errs = np.array(
-        [literal_eval(errs) for errs in xp_spectra_table["rp_coefficient_errors"]]
+    return pd.util.hash_pandas_object(fixed, index=False).values
+
+
+def ingest_xp_incremental(filename, store_path, chunksize=CHUNKSIZE, correlations=True):
+    """
+    As `read_xp_to_arrays`, but adds the .csv file to the store at `store_path`
+     incrementally: only rows whose `source_id` is new, or whose contents have
+     changed since they were ingested, are parsed.
+    The store keeps a content hash of every row (`row_hash`), alongside `ids`.
+    Each chunk of parsed rows is saved as a segment in `store_path/segments/`, and
+     `store_path/manifest.json` records which chunks of the file are done. If the
+     ingestion is interrupted, rerunning it on the same file resumes from there.
+    Once every chunk is done, the segments are merged into the store
+     (see `consolidate_segments`).
+    """
+    finish_swap(store_path)  # Of an interrupted run, before the store is read
+    segments_dir = os.path.join(store_path, "segments")
+    manifest_file = os.path.join(store_path, "manifest.json")
+    stat = os.stat(filename)
+    source = {
+        "filename": os.path.abspath(filename),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "chunksize": chunksize,
+        "correlations": correlations,
+    }
+
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    if manifest.get("source") != source:  # Not resuming; discard any partial run
+        shutil.rmtree(segments_dir, ignore_errors=True)
+        manifest = {"source": source, "done_chunks": []}
+    done_chunks = set(manifest["done_chunks"])
+
+    store = {}
+    if os.path.exists(os.path.join(store_path, "ids.npy")):
+        store = xs.load_store(store_path)
+
+    print("Reading table...")
+    chunks = pd.read_csv(
+        filename, usecols=xp_columns(correlations), chunksize=chunksize
     )
-    xp_errs = np.concatenate((bp_errs, rp_errs), axis=1)
+    for i, chunk in enumerate(chunks):
+        if i in done_chunks:
+            print(f"Chunk {i} already done, skipping...")
+            continue
+
+        hashes = row_hashes(chunk)
+        is_todo = np.ones(len(chunk), dtype=bool)
+        if "row_hash" in store:
+            rows = xs.find_rows(store, chunk["source_id"].values)
+            known = rows >= 0
+            is_todo[known] = store["row_hash"][rows[known]] != hashes[known]
+        print(f"Chunk {i}: extracting {np.sum(is_todo)} new/changed rows...")
+
+        segment_dir = os.path.join(segments_dir, f"{i:06d}")
+        arrays = allocate_xp_arrays(np.sum(is_todo), segment_dir, correlations)
+        extract_chunk(chunk[is_todo], arrays)
+        np.save(os.path.join(segment_dir, "row_hash.npy"), hashes[is_todo])
+        for arr in arrays.values():
+            arr.flush()
+
+        manifest["done_chunks"].append(i)
+        with open(f"{manifest_file}.tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{manifest_file}.tmp", manifest_file)  # Atomic
+
+    consolidate_segments(store_path)
+    os.remove(manifest_file)
+
+
+def consolidate_segments(store_path, block_size=CHUNKSIZE):
+    """
+    Merges the segments written by `ingest_xp_incremental` into the store at
+     `store_path`: rows with IDs already in the store are overwritten, and new IDs
+     are appended (the last segment wins if an ID appears more than once).
+    Arrays missing from the old store (e.g. `row_hash`) are filled with 0/NaN.
+    The merged store is written alongside the old one, then swapped in (see
+     `finish_swap`). If none of the segments have any rows, the store is unchanged.
+    """
+    segments_dir = os.path.join(store_path, "segments")
+    if finish_swap(store_path) or not os.path.isdir(segments_dir):
+        return  # Already consolidated
+    segments = [
+        xs.load_store(os.path.join(segments_dir, name))
+        for name in sorted(os.listdir(segments_dir))
+    ]
+    if sum(len(seg["ids"]) for seg in segments) == 0:
+        print(f"No new or changed rows in {len(segments)} segments")
+        shutil.rmtree(segments_dir)
+        return
+    store = {"ids": np.empty(0, dtype=np.int64)}
+    if os.path.exists(os.path.join(store_path, "ids.npy")):
+        store = xs.load_store(store_path)
+    names = list(segments[0])
+    if set(store) - set(names) - {"ids_order"}:
+        raise ValueError(f"Store has arrays not in the segments: {list(store)}")
+
+    # Destination row of every segment row: existing rows, then new IDs in order
+    n_base = len(store["ids"])
+    dest_rows = [xs.find_rows(store, seg["ids"]) for seg in segments]
+    new_ids = np.concatenate([s["ids"][d < 0] for s, d in zip(segments, dest_rows)])
+    unique_new_ids, first_seen = np.unique(new_ids, return_index=True)
+    new_rows = np.empty(len(unique_new_ids), dtype=np.int64)
+    new_rows[np.argsort(first_seen)] = n_base + np.arange(len(unique_new_ids))
+    for seg, dest in zip(segments, dest_rows):
+        dest[dest < 0] = new_rows[np.searchsorted(unique_new_ids, seg["ids"][dest < 0])]
 
-    return gaia_ids, xp_coeffs, xp_errs
+    print(f"Merging {len(segments)} segments ({len(unique_new_ids)} new rows)...")
+    tmp_path = f"{store_path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    n_total = n_base + len(unique_new_ids)
+    for name in names:
+        dtype = segments[0][name].dtype
+        merged = allocate_array(
+            (n_total,) + segments[0][name].shape[1:], tmp_path, name, dtype=dtype
+        )
+        for start in range(0, n_base, block_size):
+            block = slice(start, min(start + block_size, n_base))
+            if name in store:
+                merged[block] = store[name][block]
+            else:
+                merged[block] = 0 if np.issubdtype(dtype, np.integer) else np.nan
+        for seg, dest in zip(segments, dest_rows):
+            merged[dest] = seg[name]
+        merged.flush()
+        del merged
+    del store, segments
+    xs.index_store(tmp_path)
+    open(os.path.join(tmp_path, SWAP_MARKER), "w").close()
+    finish_swap(store_path)
+
+
+def finish_swap(store_path):
+    """
+    Swaps the merged store `{store_path}.tmp` (see `consolidate_segments`) into
+     `store_path`, file by file, keeping anything else in the directory, then
+     removes the segments it was merged from.
+    The merged store is only marked as complete (`SWAP_MARKER`) once it has been
+     written, and files are only removed from it as they're swapped in, so an
+     interrupted swap is finished by calling this again.
+    Returns whether there was a swap to finish.
+    """
+    tmp_path = f"{store_path}.tmp"
+    marker = os.path.join(tmp_path, SWAP_MARKER)
+    if not os.path.exists(marker):
+        return False
+    for fname in os.listdir(tmp_path):
+        if fname != SWAP_MARKER:
+            os.replace(os.path.join(tmp_path, fname), os.path.join(store_path, fname))
+    shutil.rmtree(os.path.join(store_path, "segments"), ignore_errors=True)
+    os.remove(marker)
+    os.rmdir(tmp_path)
+    return True
+
+
+def correlation_matrices(xp_corr, n_coeffs=N_COEFFS):
+    """
+    Unpacks correlations from the packed format of `read_xp_to_arrays`.
+    Works on any leading dimensions, e.g. (n, 2, 1485) -> (n, 2, 55, 55)
+    Missing correlations (NaNs from short rows) are set to 0.
+    """
+    xp_corr = np.asarray(xp_corr)
+    matrices = np.zeros(xp_corr.shape[:-1] + (n_coeffs, n_coeffs))
+    lower = np.tril_indices(n_coeffs, k=-1)  # == upper triangle, column-major
+    packed = np.nan_to_num(xp_corr[..., : len(lower[0])])
+    matrices[..., lower[0], lower[1]] = packed
+    matrices[..., lower[1], lower[0]] = packed
+    matrices[..., np.arange(n_coeffs), np.arange(n_coeffs)] = 1.0
+    return matrices
+
+
+def covariance_matrices(xp_err, xp_corr, rows=slice(None)):
+    """
+    Builds the full covariance matrices of the XP coefficients of the sources
+     selected by `rows`, on demand, so that they needn't all be held in memory.
+    Returns an array of shape (n, 2, 55, 55), for BP and RP respectively.
+    """
+    errs = np.asarray(xp_err[rows]).reshape(-1, 2, N_COEFFS)
+    corrs = correlation_matrices(xp_corr[rows])
+    return errs[..., :, None] * corrs * errs[..., None, :]
 
 
 WLEN_GRID = np.arange(336, 1021, 2)
 
 
-def sample_xp_spectra(filename, wlen_grid=WLEN_GRID):
+@pr.profiled(rows=lambda result: len(result[0]))
+def sample_xp_spectra(filename, wlen_grid=WLEN_GRID, n_workers=None, shard_size=None):
     """
     Converts a .csv file containing XP coefficients (and errors) to numpy arrays
      containing the spectra sampled at the given wavelengths
+    If `n_workers` is given, the file is split into shards of `shard_size` rows
+     (default: spread evenly over the workers), which are calibrated in parallel
+     across a pool of `n_workers` processes. See `sample_xp_spectra_parallel`.
     Returns:
     - gaia_ids: The Gaia EDR3 IDs (N,)
     - fluxes: The spectra (N, len(wlen_grid))
     - flux_errs: The errors on the spectra (N, len(wlen_grid))
     """
+    if n_workers is not None:
+        return sample_xp_spectra_parallel(filename, wlen_grid, n_workers, shard_size)
+
     print("Reading table...")
     calibrated_df, _ = calibrate(filename, sampling=wlen_grid, save_file=False)
 
@@ -71,24 +430,270 @@ def sample_xp_spectra(filename, wlen_grid=WLEN_GRID):
     return ids_, fluxes_, flux_errs_
 
 
+def parse_array_columns(shard):
+    """
+    Parses the bracketed coefficient, error and correlation strings of a shard of
+     the .csv file to float arrays (one per row, of its own length), as
+     `gaiaxpy.calibrate` only parses them itself when reading from a file
+    """
+    shard = shard.copy()
+    for col in COEFF_COLUMNS + ERR_COLUMNS + CORR_COLUMNS:
+        shard[col] = [
+            np.fromstring(s.strip("()[] \t"), sep=",") if isinstance(s, str) else s
+            for s in shard[col]
+        ]
+    return shard
+
+
+def calibrate_shard(shard, wlen_grid):
+    "Calibrates a shard (DataFrame, from `parse_array_columns`) of the .csv file"
+    calibrated_df, _ = calibrate(shard, sampling=wlen_grid, save_file=False)
+    return (
+        calibrated_df["source_id"].values,
+        np.array(calibrated_df["flux"].values.tolist()),
+        np.array(calibrated_df["flux_error"].values.tolist()),
+    )
+
+
+def sample_xp_spectra_parallel(
+    filename, wlen_grid=WLEN_GRID, n_workers=None, shard_size=None, max_retries=2
+):
+    """
+    As `sample_xp_spectra`, but parses the file once, in shards of `shard_size` rows,
+     and calibrates the shards across a pool of `n_workers` processes (default: all
+     cores). At most two shards per worker are read ahead, to bound memory.
+    If `shard_size` isn't given, the file is first scanned to count its rows (see
+     `count_rows`), so that there is one shard per worker.
+    Shards that fail are retried on their own, up to `max_retries` times. If a
+     worker dies (e.g. killed for running out of memory), the pool is broken, so the
+     shards in flight are retried in a new pool, each counting it as a failure.
+    The outputs are concatenated in the original row order of the file.
+    """
+    n_workers = n_workers or os.cpu_count()
+    if shard_size is None:
+        shard_size = max(1, -(-count_rows(filename) // n_workers))
+    print(f"Calibrating spectra in shards of {shard_size}...")
+
+    reader = enumerate(pd.read_csv(filename, chunksize=shard_size))
+    shards, results, n_attempts = {}, {}, {}
+    pool = ProcessPoolExecutor(max_workers=n_workers)
+    pending, waiting = {}, []  # Shards in flight, and to be submitted
+    try:
+        while True:
+            while len(pending) + len(waiting) < 2 * n_workers:
+                i, shard = next(reader, (None, None))
+                if shard is None:
+                    break
+                shards[i], n_attempts[i] = parse_array_columns(shard), 0
+                waiting.append(i)
+            try:
+                while waiting:
+                    future = pool.submit(calibrate_shard, shards[waiting[0]], wlen_grid)
+                    pending[future] = waiting.pop(0)
+            except BrokenProcessPool:  # The shards in flight fail below
+                if not pending:
+                    pool = ProcessPoolExecutor(max_workers=n_workers)
+                    continue
+            if not pending:
+                break
+
+            future = next(as_completed(pending))
+            i = pending.pop(future)
+            try:
+                results[i] = future.result()
+            except Exception as err:
+                failed = [i]
+                if isinstance(err, BrokenProcessPool):  # All in flight have failed
+                    failed += list(pending.values())
+                    pending = {}
+                    pool.shutdown(cancel_futures=True)
+                    pool = ProcessPoolExecutor(max_workers=n_workers)
+                for i in failed:  # Retry these shards alone
+                    n_attempts[i] += 1
+                    if n_attempts[i] > max_retries:
+                        raise RuntimeError(f"Shard {i} failed") from err
+                    print(f"Shard {i} failed ({err!r}); retrying...")
+                waiting = failed + waiting
+                continue
+            del shards[i]
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    return tuple(
+        np.concatenate([results[i][j] for i in sorted(results)]) for j in range(3)
+    )
+
+
+DESIGN_MATRIX_DIR = "../data/interim/design_matrices"
+
+
+def design_matrix(wlen_grid=WLEN_GRID, cache_dir=DESIGN_MATRIX_DIR):
+    """
+    The (110, len(wlen_grid)) design matrix D of the XP calibration, such that the
+     sampled spectra are `xp @ D` (BP and RP, merged as by `gaiaxpy.calibrate`).
+    The calibration is linear in the coefficients, so D is found by calibrating the
+     110 unit vectors once. It is cached in `cache_dir`, keyed by a hash of the grid
+     (and the GaiaXPy version).
+    """
+    wlen_grid = np.asarray(wlen_grid, dtype=np.float64)
+    key = hashlib.sha1(gaiaxpy_version.encode() + wlen_grid.tobytes()).hexdigest()
+    cache_file = os.path.join(cache_dir, f"design_matrix_{key[:16]}.npy")
+    if os.path.exists(cache_file):
+        return np.load(cache_file)
+
+    print("Building design matrix...")
+    n_basis = 2 * N_COEFFS
+    basis = np.eye(n_basis)
+    basis_df = pd.DataFrame(
+        {
+            "source_id": np.arange(1, n_basis + 1),
+            "bp_coefficients": list(basis[:, :N_COEFFS]),
+            "rp_coefficients": list(basis[:, N_COEFFS:]),
+            "bp_coefficient_errors": [np.ones(N_COEFFS)] * n_basis,
+            "rp_coefficient_errors": [np.ones(N_COEFFS)] * n_basis,
+            "bp_coefficient_correlations": [np.zeros(N_CORRS)] * n_basis,
+            "rp_coefficient_correlations": [np.zeros(N_CORRS)] * n_basis,
+            "bp_n_parameters": N_COEFFS,
+            "rp_n_parameters": N_COEFFS,
+            "bp_standard_deviation": 1.0,
+            "rp_standard_deviation": 1.0,
+        }
+    )
+    calibrated_df, _ = calibrate(basis_df, sampling=wlen_grid, save_file=False)
+    design = np.array(calibrated_df["flux"].values.tolist())
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(cache_file, design)
+    return design
+
+
+@pr.profiled()
+def sample_xp_coefficients(
+    xp,
+    xp_err=None,
+    xp_corr=None,
+    wlen_grid=WLEN_GRID,
+    batch_size=CHUNKSIZE,
+    out_dir=None,
+):
+    """
+    Samples spectra straight from the XP coefficients (e.g. from
+     `read_xp_to_arrays`) with batched matrix multiplications by the design matrix,
+     rather than going back through `gaiaxpy.calibrate` and the .csv file.
+    Missing (NaN) coefficients contribute nothing.
+    The errors are propagated from the full covariances if `xp_corr` is given
+     (at most `COV_BATCH_SIZE` rows at a time, as each row's covariances and their
+     product with the design matrix take ~0.4 MB), otherwise from `xp_err` alone
+     (ignoring correlations).
+    If `out_dir` is given, the outputs are disk-backed .npy memmaps in that directory
+     (`flux.npy`, `flux_err.npy`).
+    Returns:
+    - fluxes: The spectra (N, len(wlen_grid))
+    - flux_errs: The errors on the spectra (N, len(wlen_grid)), if `xp_err` is given
+    """
+    design = design_matrix(wlen_grid)
+    design_by_band = design.reshape(2, N_COEFFS, -1)
+    n_rows = len(xp)
+    if xp_err is not None and xp_corr is not None:
+        batch_size = min(batch_size, COV_BATCH_SIZE)
+
+    fluxes = allocate_array((n_rows, len(wlen_grid)), out_dir, "flux")
+    if xp_err is not None:
+        flux_errs = allocate_array((n_rows, len(wlen_grid)), out_dir, "flux_err")
+
+    for start in range(0, n_rows, batch_size):
+        rows = slice(start, min(start + batch_size, n_rows))
+        fluxes[rows] = np.nan_to_num(xp[rows]) @ design
+        if xp_err is None:
+            continue
+        if xp_corr is None:
+            flux_vars = np.nan_to_num(xp_err[rows]) ** 2 @ design**2
+        else:
+            covs = np.nan_to_num(covariance_matrices(xp_err, xp_corr, rows))
+            flux_vars = np.sum(design_by_band * (covs @ design_by_band), axis=(1, 2))
+        # Negative variances (from non-positive-definite covariances) -> NaN
+        flux_errs[rows] = np.sqrt(np.where(flux_vars >= 0, flux_vars, np.nan))
+
+    if xp_err is None:
+        return fluxes
+    return fluxes, flux_errs
+
+
+def sample_store_incremental(
+    coeffs_path, sampled_path, wlen_grid=WLEN_GRID, block_size=CHUNKSIZE
+):
+    """
+    Samples the spectra of the XP coefficients in the store at `coeffs_path` (see
+     `sample_xp_coefficients`) into the store at `sampled_path`, `block_size` rows
+     at a time.
+    The sampled store keeps the `row_hash` of the coefficients of each row, so only
+     rows whose coefficients are new or have changed since they were sampled are
+     sampled again; the rest are copied over.
+    The new arrays are written alongside the old ones and swapped in, with
+     `row_hash` last, so an interrupted swap just means sampling everything again.
+    """
+    coeffs = xs.load_store(coeffs_path)
+    n_rows = len(coeffs["ids"])
+    hashes = coeffs.get("row_hash")
+
+    old = {}
+    if os.path.exists(os.path.join(sampled_path, "row_hash.npy")):
+        old = xs.load_store(sampled_path)
+    if old and not np.array_equal(old["wlen"], wlen_grid):
+        old = {}
+    old_rows = np.full(n_rows, -1)
+    if old and hashes is not None:
+        old_rows = xs.find_rows(old, coeffs["ids"])
+        known = old_rows >= 0
+        known[known] = old["row_hash"][old_rows[known]] == hashes[known]
+        old_rows[~known] = -1
+    is_todo = old_rows < 0
+    if old and not np.any(is_todo) and len(old["ids"]) == n_rows:
+        print("All spectra already sampled")
+        return
+    print(f"Sampling {np.sum(is_todo)} new/changed spectra of {n_rows}...")
+
+    tmp_path = f"{sampled_path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    fluxes = allocate_array((n_rows, len(wlen_grid)), tmp_path, "flux")
+    flux_errs = allocate_array((n_rows, len(wlen_grid)), tmp_path, "flux_err")
+    for start in range(0, n_rows, block_size):
+        block = np.arange(start, min(start + block_size, n_rows))
+        done, todo = block[~is_todo[block]], block[is_todo[block]]
+        if len(done):
+            fluxes[done] = old["flux"][old_rows[done]]
+            flux_errs[done] = old["flux_err"][old_rows[done]]
+        if len(todo) == 0:
+            continue
+        corr = coeffs["xp_corr"][todo] if "xp_corr" in coeffs else None
+        fluxes[todo], flux_errs[todo] = sample_xp_coefficients(
+            coeffs["xp"][todo], coeffs["xp_err"][todo], corr, wlen_grid, block_size
+        )
+    fluxes.flush()
+    flux_errs.flush()
+    del fluxes, flux_errs, old
+    xs.save_store(tmp_path, ids=coeffs["ids"], wlen=wlen_grid)
+    if hashes is not None:
+        np.save(os.path.join(tmp_path, "row_hash.npy"), hashes)
+
+    os.makedirs(sampled_path, exist_ok=True)
+    if os.path.exists(os.path.join(sampled_path, "row_hash.npy")):
+        os.remove(os.path.join(sampled_path, "row_hash.npy"))
+    for fname in sorted(os.listdir(tmp_path), key=lambda f: f == "row_hash.npy"):
+        os.replace(os.path.join(tmp_path, fname), os.path.join(sampled_path, fname))
+    os.rmdir(tmp_path)
+
+
 if __name__ == "__main__":
     XP_FILE = "../data/external/xp.csv"
+    XP_COEFFS_STORE = "../data/interim/xp_coeffs"
+    XP_SAMPLED_STORE = "../data/interim/xp_sampled"
 
     print("Extracting XP coefficients...")
-    ids, xp, xp_err = read_xp_to_arrays(XP_FILE)
-    np.savez_compressed(
-        "../data/interim/xp_coeffs.npz",
-        ids=ids,
-        xp=xp,
-        xp_err=xp_err,
-    )
+    with pr.stage("ingest_xp_incremental") as record:
+        ingest_xp_incremental(XP_FILE, XP_COEFFS_STORE)  # Only new/changed rows
+        record["rows"] = len(xs.load_store(XP_COEFFS_STORE)["ids"])
 
     print("Sampling XP spectra...")
-    ids, flux, flux_err = sample_xp_spectra(XP_FILE)
-    np.savez_compressed(
-        "../data/interim/xp_sampled.npz",
-        ids=ids,
-        wlen=WLEN_GRID,
-        flux=flux,
-        flux_err=flux_err,
-    )
+    sample_store_incremental(XP_COEFFS_STORE, XP_SAMPLED_STORE)  # Only changed rows
+    pr.write_report()
@@ -0,0 +1,205 @@
+"""
+profiling.py
+============
+Timing and memory instrumentation of the pipeline's stages.
+Wrap a stage in `with stage(name, rows=...)`, or decorate a function with
+`@profiled()`, to record its wall time, CPU time (including that of any worker
+processes it waits for), RSS at the start and peak RSS, and the number of rows it
+processed.
+Recording is off unless the environment variable `XP_PROFILE=1` is set. The
+records of a run are then written to a JSON report in `data/interim/profiles/`,
+and summarised on stdout, by `write_report`, which the scripts call at the end of
+their `__main__` (and `pipeline.py` after each stage); importing an instrumented
+module never writes anything.
+Peak RSS is per stage on Linux, where the kernel's high-water mark (of the whole
+process) is reset at the start of each stage; elsewhere it is the peak of the
+process so far.
+"""
+
+import contextlib
+import datetime
+import functools
+import json
+import os
+import resource
+import sys
+import time
+
+REPORT_DIR = "../data/interim/profiles"
+ENABLED = os.environ.get("XP_PROFILE", "0") == "1"
+
+RECORDS = []  # Stages since the last report, in the order they started
+OPEN_STAGES = []  # Stages in progress, innermost last
+
+
+# --------------------------
+# Memory
+
+
+def read_proc_status(field):
+    "A memory field (e.g. VmRSS) of /proc/self/status, in bytes; None if not Linux"
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def read_peak_rss():
+    "Peak RSS of this process (bytes) since the last `reset_peak_rss`, or ever"
+    peak = read_proc_status("VmHWM")
+    if peak is not None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Else in KiB
+
+
+def reset_peak_rss():
+    "Resets the peak RSS to the current RSS (Linux only); False if it can't"
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def update_open_peaks():
+    "Folds the peak RSS so far into every stage in progress, before it's reset"
+    peak = read_peak_rss()
+    for record in OPEN_STAGES:
+        record["peak_rss"] = max(record["peak_rss"], peak)
+
+
+def children_cpu_time():
+    "CPU time of the finished child processes which have been waited for"
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+# --------------------------
+# Recording stages
+
+
+@contextlib.contextmanager
+def stage(name, rows=None):
+    """
+    Records the wall time, CPU time and peak RSS of the enclosed block, as stage
+     `name`. Yields the record (a dict), so `rows` can also be set inside the block,
+     e.g. once a table has been read.
+    Stages can be nested; each record notes its `parent`.
+    """
+    record = {
+        "name": name,
+        "parent": OPEN_STAGES[-1]["name"] if OPEN_STAGES else None,
+        "depth": len(OPEN_STAGES),
+        "rows": rows,
+        "peak_rss": 0,
+    }
+    if not ENABLED:
+        yield record
+        return
+
+    update_open_peaks()
+    reset_peak_rss()
+    record["start_rss"] = read_proc_status("VmRSS") or read_peak_rss()
+    OPEN_STAGES.append(record)
+    RECORDS.append(record)
+    start = datetime.datetime.now().isoformat(timespec="seconds")
+    wall = time.perf_counter()
+    cpu = time.process_time() + children_cpu_time()
+    try:
+        yield record
+    finally:
+        record["wall_time"] = time.perf_counter() - wall
+        record["cpu_time"] = time.process_time() + children_cpu_time() - cpu
+        record["start"] = start
+        update_open_peaks()
+        OPEN_STAGES.remove(record)
+
+
+def default_rows(args, result):
+    "The length of the first argument (e.g. the data), if it has one"
+    if args and hasattr(args[0], "__len__") and not isinstance(args[0], str):
+        return len(args[0])
+    return None
+
+
+def profiled(name=None, rows=None):
+    """
+    Decorator recording each call of a function as a stage (see `stage`), named
+     `name` (default: the function's name).
+    `rows` is a function of the result giving the number of rows processed; by
+     default, it is the length of the first argument.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__) as record:
+                result = func(*args, **kwargs)
+                if rows is None:
+                    record["rows"] = default_rows(args, result)
+                else:
+                    record["rows"] = rows(result)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+# --------------------------
+# Reports
+
+
+def summarise(records):
+    "A table of the records, one line per stage"
+    lines = [f"{'stage':<28} {'rows':>10} {'wall/s':>9} {'cpu/s':>9} {'peak MB':>9}"]
+    for r in records:
+        name = "  " * r["depth"] + r["name"]
+        rows = "" if r["rows"] is None else r["rows"]
+        lines.append(
+            f"{name:<28} {rows:>10} {r['wall_time']:>9.2f} {r['cpu_time']:>9.2f}"
+            f" {r['peak_rss'] / 2**20:>9.0f}"
+        )
+    return "\n".join(lines)
+
+
+def write_report(run_name=None, report_dir=REPORT_DIR):
+    """
+    Writes the records of the stages finished since the last report to
+     `report_dir/{run_name}_{timestamp}_{pid}.json` (`run_name` defaulting to the
+     script's name), prints a summary, and clears them.
+    Returns the path of the report, or None if there was nothing to report.
+    """
+    finished = [r for r in RECORDS if "wall_time" in r]
+    if not finished:
+        return None
+    run_name = run_name or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    path = os.path.join(report_dir, f"{run_name}_{timestamp}_{os.getpid()}.json")
+    report = {
+        "run": run_name,
+        "argv": sys.argv,
+        "pid": os.getpid(),
+        "finished": datetime.datetime.now().isoformat(timespec="seconds"),
+        "stages": finished,
+    }
+    os.makedirs(report_dir, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1)
+
+    print(f"Profile of {run_name} (saved to {path}):")
+    print(summarise(finished))
+    RECORDS[:] = [r for r in RECORDS if "wall_time" not in r]
+    return path
+
+
+def load_report(path):
+    "Loads a report written by `write_report`"
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,190 @@
+"""
+sweep_dim_reduce.py
+===================
+Runs `umap_tsne_xp.dim_reduce` over a grid of parameters (method, preprocessor,
+and any of its kwargs, e.g. `perplexity`, `n_neighbors`, `min_dist`,
+`random_state`), with the configurations spread across a pool of processes.
+Each job's thread pools (BLAS, OpenMP, numba) are capped, so that the jobs don't
+oversubscribe the cores between them.
+Each result is saved to `data/interim/sweeps/{key}.npz`, where `key` is a hash of
+the input data (including the errors and correlations, which error-weighting
+preprocessors use), preprocessor, method and kwargs, so configurations which have
+already run are skipped.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import gf21_catalogue as gf
+import umap_tsne_xp as ut
+import xp_store as xs
+
+XP_COEFFS_STORE = "../data/interim/xp_coeffs"
+SWEEP_DIR = "../data/interim/sweeps"
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+HASHED_ARRAYS = ["ids", "xp", "xp_err", "xp_corr"]  # The inputs of `run_config`
+
+
+def parameter_grid(grid):
+    """
+    Expands a grid, a dict of parameter -> list of values (or a single value), into
+     a list of configurations, one for each combination of values, e.g.
+    {"method": "tsne", "perplexity": [30, 50]} ->
+     [{"method": "tsne", "perplexity": 30}, {"method": "tsne", "perplexity": 50}]
+    A list of grids gives the configurations of each in turn.
+    """
+    if isinstance(grid, list):
+        return [config for g in grid for config in parameter_grid(g)]
+    values = [v if isinstance(v, list) else [v] for v in grid.values()]
+    return [dict(zip(grid, combination)) for combination in itertools.product(*values)]
+
+
+def inputs_hash(store):
+    "Content hash of the arrays of the store which the configurations read"
+    return xs.array_hash(*[store[name] for name in HASHED_ARRAYS if name in store])
+
+
+def config_key(data_hash, config):
+    "Content hash of the input data and a configuration"
+    config = {"preprocessor": "divide_Gflux", **config}
+    payload = json.dumps({"data": data_hash, **config}, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+def limit_threads(n_threads):
+    "Caps the thread pools of this (worker) process at `n_threads`"
+    from threadpoolctl import threadpool_limits
+
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    threadpool_limits(n_threads)
+    try:
+        import numba
+
+        numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+    except ImportError:
+        pass
+
+
+def run_config(store_path, config, out_file, n_threads):
+    """
+    Runs one configuration on the XP coefficients in the store at `store_path`,
+     saving the embedding, IDs and configuration (as JSON) to `out_file`.
+    """
+    kwargs = dict(config)
+    method = kwargs.pop("method")
+    preprocessor = kwargs.pop("preprocessor", "divide_Gflux")
+    kwargs.setdefault("n_jobs", n_threads)
+
+    store = xs.load_store(store_path)
+    ids = np.asarray(store["ids"])
+    embedding = ut.dim_reduce(
+        np.asarray(store["xp"]),
+        method,
+        preprocessor=preprocessor,
+        ids=ids,
+        xp_err=store["xp_err"],
+        xp_corr=store.get("xp_corr"),
+        **kwargs,
+    )
+
+    tmp_file = f"{out_file}.tmp.npz"  # So that interrupted jobs aren't counted
+    np.savez_compressed(
+        tmp_file, ids=ids, embedding=embedding, config=json.dumps(config)
+    )
+    os.replace(tmp_file, out_file)
+
+
+def sweep(
+    grid, store_path=XP_COEFFS_STORE, out_dir=SWEEP_DIR, n_workers=None, n_threads=1
+):
+    """
+    Runs `dim_reduce` for every configuration in `grid` (see `parameter_grid`) on
+     the XP coefficients in the store at `store_path`.
+    Each configuration needs a "method", and may give a "preprocessor" (the name of
+     a function in `preprocessors.py`, or of the steps of a chain joined by "+",
+     e.g. "divide_Gflux+error_weight"; default "divide_Gflux"); the rest are passed
+     to `dim_reduce`.
+    Runs across `n_workers` processes (default: as many as fit in the cores), each
+     limited to `n_threads` threads; configurations already in `out_dir` are skipped.
+    If any configurations fail, raises a RuntimeError once the others have finished.
+    Returns a list of (configuration, result file) for every configuration.
+    """
+    n_workers = n_workers or max(1, os.cpu_count() // n_threads)
+    data_hash = inputs_hash(xs.load_store(store_path))
+
+    configs = parameter_grid(grid)
+    out_files = [
+        os.path.join(out_dir, f"{config_key(data_hash, config)}.npz")
+        for config in configs
+    ]
+    todo = {
+        i: config
+        for i, (config, out_file) in enumerate(zip(configs, out_files))
+        if not os.path.exists(out_file)
+    }
+    print(f"Running {len(todo)} of {len(configs)} configurations...")
+    os.makedirs(out_dir, exist_ok=True)
+    if todo:
+        gf.load_catalogue()  # Built here if needed, rather than by every worker at once
+
+    failed = []
+    with ProcessPoolExecutor(
+        max_workers=n_workers, initializer=limit_threads, initargs=(n_threads,)
+    ) as pool:
+        pending = {
+            pool.submit(run_config, store_path, config, out_files[i], n_threads): i
+            for i, config in todo.items()
+        }
+        for future in as_completed(pending):
+            i = pending[future]
+            try:
+                future.result()
+                print(f"Done: {configs[i]}")
+            except Exception as err:
+                print(f"Failed: {configs[i]} ({err!r})")
+                failed.append(configs[i])
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} configurations failed, e.g. {failed[0]}")
+    return list(zip(configs, out_files))
+
+
+def load_result(config, store_path=XP_COEFFS_STORE, out_dir=SWEEP_DIR):
+    "Loads the saved (ids, embedding) of a configuration, which must have been run"
+    data_hash = inputs_hash(xs.load_store(store_path))
+    with np.load(os.path.join(out_dir, f"{config_key(data_hash, config)}.npz")) as fl:
+        return fl["ids"], fl["embedding"]
+
+
+if __name__ == "__main__":
+    sweep(
+        [
+            {
+                "method": "tsne",
+                "preprocessor": [
+                    "divide_Gflux",
+                    "l2_norm",
+                    "divide_Gflux+error_weight",
+                ],
+                "perplexity": [30, 50, 100],
+                "random_state": [0, 1],
+            },
+            {
+                "method": "umap",
+                "preprocessor": [
+                    "divide_Gflux",
+                    "l2_norm",
+                    "divide_Gflux+error_weight",
+                ],
+                "n_neighbors": [15, 25, 50],
+                "min_dist": [0.05, 0.1],
+                "random_state": [0, 1],
+            },
+        ]
+    )
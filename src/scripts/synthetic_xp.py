@@ -0,0 +1,215 @@
+"""
+synthetic_xp.py
+===============
+Generates synthetic datasets in the formats of the real inputs, so the pipeline can
+be run and benchmarked without a Gaia@AIP account or network access:
+- `data/external/xp.csv`: XP coefficients, with the columns of
+  `queries/gaia_aip_xp.sql`
+- `data/interim/gf21_filtered.csv`: the GF+21 catalogue, with the columns of
+  `queries/gf21.sql`
+- `data/external/evaluation/{gf21_sdss,mwdd,pewdd}.csv`: spectral classes of some
+  of the sources, in the formats read by `check_polluted.py`
+Each dataset is laid out like `src/`, in `data/interim/synthetic/n{n}_seed{seed}/`,
+with an empty `scripts/` directory to run from, so that the scripts' `../data/...`
+paths resolve to it.
+The sources belong to a few classes, each with its own XP spectrum (up to noise)
+and colour; two classes are polluted (DAZ and DBZ), so the tSNE embedding has
+polluted islands to find. The coefficients scale with the G-band flux, as the real
+ones do, so `preprocessors.divide_Gflux` recovers the class spectra.
+"""
+
+import io
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+N_COEFFS = 55  # Per band, as in `process_xp.py`
+N_CORRS = N_COEFFS * (N_COEFFS - 1) // 2
+SYNTHETIC_DIR = "../data/interim/synthetic"
+CHUNKSIZE = 10_000  # Rows generated and written at a time
+G_ZEROPOINT = 25.7934  # As in `preprocessors.py`
+
+# Spectral class: (fraction of sources, BP-RP, TeffH)
+CLASSES = {
+    "DA": (0.55, 0.0, 12_000),
+    "DB": (0.15, -0.2, 18_000),
+    "DC": (0.15, 0.5, 6_000),
+    "DQ": (0.05, 0.3, 9_000),
+    "DAZ": (0.05, 0.35, 7_000),  # The cool polluted island
+    "DBZ": (0.05, -0.1, 14_000),  # The warm polluted island
+}
+LABELLED_FRACTION = 0.3  # Fraction of sources with an SDSS spectrum
+MWDD_FRACTION = 0.1
+SCATTER = 0.05  # Relative scatter of the spectra within each class
+
+
+# --------------------------
+# Sources
+
+
+def class_spectra(rng):
+    "A spectrum (110 XP coefficients, normalised by G flux) for each class"
+    decay = np.exp(-np.arange(N_COEFFS) / 8)
+    spectra = rng.normal(size=(len(CLASSES), 2, N_COEFFS)) * decay
+    spectra[:, :, 0] = np.abs(spectra[:, :, 0]) + 1  # Positive mean flux
+    return spectra.reshape(len(CLASSES), 2 * N_COEFFS) * 1e-4
+
+
+def make_ids(n_sources, rng):
+    "Unique, sorted Gaia-like (19-digit) source IDs"
+    ids = np.unique(rng.integers(10**18, 7 * 10**18, size=int(n_sources * 1.01)))
+    return np.sort(rng.choice(ids, size=n_sources, replace=False))
+
+
+def make_sources(n_sources, rng):
+    """
+    The IDs, classes (indices into `CLASSES`) and G magnitudes of `n_sources`
+     synthetic WDs
+    """
+    fractions = np.array([c[0] for c in CLASSES.values()])
+    return (
+        make_ids(n_sources, rng),
+        rng.choice(len(CLASSES), size=n_sources, p=fractions / fractions.sum()),
+        rng.uniform(15, 20.5, size=n_sources),
+    )
+
+
+# --------------------------
+# Tables
+
+
+def format_arrays(values, fmt="%.6e"):
+    "Formats each row of `values` as a bracketed, comma-separated string"
+    buf = io.StringIO()
+    np.savetxt(buf, values, fmt=fmt, delimiter=", ")
+    return ["[" + row + "]" for row in buf.getvalue().splitlines()]
+
+
+def xp_table(ids, classes, Gmag, spectra, rng, correlations=True):
+    """
+    A chunk of the XP table, with the columns of `gaia_aip_xp.sql`.
+    Without `correlations`, the correlation columns are left empty (null), which
+     keeps large tables small, as `read_xp_to_arrays` doesn't read them by default.
+    """
+    n = len(ids)
+    Gflux = 10 ** (-0.4 * (Gmag - G_ZEROPOINT))
+    shape = spectra[classes] * (1 + SCATTER * rng.normal(size=(n, 2 * N_COEFFS)))
+    xp = shape * Gflux[:, None]
+    xp_err = 0.02 * np.abs(xp) + 0.002 * np.abs(xp).mean(axis=1, keepdims=True)
+
+    bands = {"bp": slice(0, N_COEFFS), "rp": slice(N_COEFFS, 2 * N_COEFFS)}
+    table = {"source_id": ids}  # In the order of `gaia_aip_xp.sql`
+    for band, cols in bands.items():
+        table[f"{band}_coefficients"] = format_arrays(xp[:, cols])
+    for band, cols in bands.items():
+        table[f"{band}_coefficient_errors"] = format_arrays(xp_err[:, cols])
+    for band in bands:
+        if correlations:
+            corrs = rng.uniform(-0.3, 0.3, size=(n, N_CORRS))
+            table[f"{band}_coefficient_correlations"] = format_arrays(corrs, "%.4f")
+        else:
+            table[f"{band}_coefficient_correlations"] = ""
+    for band in bands:
+        table[f"{band}_n_parameters"] = N_COEFFS
+        table[f"{band}_standard_deviation"] = rng.uniform(0.8, 1.5, size=n)
+    return pd.DataFrame(table)
+
+
+def gf21_table(ids, classes, Gmag, rng):
+    "The GF+21 catalogue, with the columns of `gf21.sql`"
+    BPRP = np.array([c[1] for c in CLASSES.values()])[classes]
+    BPRP = BPRP + rng.normal(scale=0.05, size=len(ids))
+    Teff = np.array([c[2] for c in CLASSES.values()])[classes]
+    return pd.DataFrame(
+        {
+            "GaiaEDR3": ids,
+            "Gmag": Gmag,
+            "BPmag": Gmag + 0.5 * BPRP,
+            "RPmag": Gmag - 0.5 * BPRP,
+            "Plx": rng.uniform(2, 50, size=len(ids)),
+            "Pwd": rng.uniform(0.75, 1, size=len(ids)),
+            "TeffH": Teff * rng.uniform(0.8, 1.2, size=len(ids)),
+        }
+    )
+
+
+def evaluation_tables(ids, classes, rng):
+    """
+    The spectral classes of some of the sources, as GF21xSDSS (`specClass`), MWDD
+     (`spectype`) and PEWDD (the polluted WDs, by `Gaia_designation`) tables
+    """
+    names = np.array(list(CLASSES))[classes]
+    in_sdss = rng.random(len(ids)) < LABELLED_FRACTION
+    in_mwdd = rng.random(len(ids)) < MWDD_FRACTION
+    is_polluted = np.char.endswith(names.astype(str), "Z")
+    in_pewdd = is_polluted & (rng.random(len(ids)) < 0.2)
+    return {
+        "gf21_sdss": pd.DataFrame(
+            {"GaiaEDR3": ids[in_sdss], "specClass": names[in_sdss]}
+        ),
+        "mwdd": pd.DataFrame({"gaiaedr3": ids[in_mwdd], "spectype": names[in_mwdd]}),
+        "pewdd": pd.DataFrame(
+            {"Gaia_designation": [f"Gaia DR3 {id_}" for id_ in ids[in_pewdd]]}
+        ),
+    }
+
+
+# --------------------------
+# Datasets
+
+
+def dataset_dir(n_sources, seed=0, root=SYNTHETIC_DIR):
+    "The directory of a synthetic dataset (laid out like `src/`)"
+    return os.path.join(root, f"n{n_sources}_seed{seed}")
+
+
+def write_dataset(n_sources, seed=0, root=SYNTHETIC_DIR, correlations=False):
+    """
+    Writes a synthetic dataset of `n_sources` WDs (see the module docstring), unless
+     it already exists. The XP table is generated and written `CHUNKSIZE` rows at a
+     time, so memory doesn't grow with `n_sources`.
+    Returns the dataset's `scripts/` directory, to run the scripts from.
+    """
+    out_dir = dataset_dir(n_sources, seed, root)
+    scripts_dir = os.path.join(out_dir, "scripts")
+    if os.path.exists(os.path.join(out_dir, "done")):
+        return scripts_dir
+
+    print(f"Generating synthetic dataset of {n_sources} sources...")
+    shutil.rmtree(out_dir, ignore_errors=True)
+    for sub in [
+        "scripts",
+        "data/external/evaluation",
+        "data/interim",
+        "data/processed",
+    ]:
+        os.makedirs(os.path.join(out_dir, sub), exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    ids, classes, Gmag = make_sources(n_sources, rng)
+    spectra = class_spectra(rng)
+
+    xp_file = os.path.join(out_dir, "data/external/xp.csv")
+    for start in range(0, n_sources, CHUNKSIZE):
+        rows = slice(start, start + CHUNKSIZE)
+        chunk = xp_table(
+            ids[rows], classes[rows], Gmag[rows], spectra, rng, correlations
+        )
+        chunk.to_csv(xp_file, mode="a", header=start == 0, index=False)
+
+    gf21 = gf21_table(ids, classes, Gmag, rng)
+    gf21.to_csv(os.path.join(out_dir, "data/interim/gf21_filtered.csv"), index=False)
+    for name, table in evaluation_tables(ids, classes, rng).items():
+        table.to_csv(
+            os.path.join(out_dir, f"data/external/evaluation/{name}.csv"), index=False
+        )
+
+    open(os.path.join(out_dir, "done"), "w").close()
+    return scripts_dir
+
+
+if __name__ == "__main__":
+    for n_sources in [10_000, 100_000]:
+        write_dataset(n_sources)
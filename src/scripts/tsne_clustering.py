@@ -0,0 +1,214 @@
+"""
+tsne_clustering.py
+==================
+DBSCAN (Ester+96) clustering of the tSNE embedding, computed once and shared by
+`isolate_polluted_islands.py` and `create_fig_tsneclustering.py`.
+The clustering (sklearn's DBSCAN, with KD-tree neighbour queries in parallel) is
+cached in `data/interim/clustering/`, keyed by a hash of the embedding and the
+parameters.
+The two polluted islands are identified by their overlap with the WDs known to be
+polluted (the number of them they contain; see `check_polluted.py`), rather than
+by their cluster numbers, and told apart by colour: the cool island is the redder
+in BP-RP.
+To choose `eps`, `build_hierarchy` fits HDBSCAN (Campello+13) once; its single
+linkage tree of mutual reachability distances can be cut at any `eps`, in O(N), to
+give the DBSCAN clustering at that `eps`. `scan_eps` does so for a range of `eps`,
+reporting the size and purity of the polluted islands at each.
+"""
+
+import os
+import pickle
+
+import numpy as np
+from scipy.spatial import cKDTree
+from sklearn.cluster import DBSCAN, HDBSCAN
+
+import check_polluted as cp
+import gf21_catalogue as gf
+import profiling as pr
+import xp_store as xs
+
+EMBEDDING_FILE = "../data/processed/tsne_xp.npz"
+CLUSTERING_DIR = "../data/interim/clustering"
+EPS = 2
+MIN_SAMPLES = 30
+
+
+def cluster_embedding(
+    ids, embedding, eps=EPS, min_samples=MIN_SAMPLES, cache_dir=CLUSTERING_DIR
+):
+    """
+    The DBSCAN labels of `embedding`, computed once and cached in `cache_dir`,
+     keyed by a hash of the IDs, embedding and parameters
+    """
+    key = xs.array_hash(ids, embedding, np.array([eps, min_samples], dtype=float))
+    cache_file = os.path.join(cache_dir, f"dbscan_{key}.npy")
+    if os.path.exists(cache_file):
+        return np.load(cache_file)
+
+    print("Clustering embedding...")
+    dbscan = DBSCAN(eps=eps, min_samples=min_samples, algorithm="kd_tree", n_jobs=-1)
+    with pr.stage("dbscan", rows=len(embedding)):
+        labels = dbscan.fit(embedding).labels_
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(cache_file, labels)
+    return labels
+
+
+def cluster_overlap(ids, labels):
+    """
+    The overlap of each cluster with the known polluted WDs (see
+     `check_polluted.is_polluted_many`).
+    Returns the cluster labels (excluding noise), and the number of their members
+     which are known polluted, and which have a known label.
+    """
+    polluted = cp.is_polluted_many(ids)
+    is_known = polluted >= 0
+    clusters, members = np.unique(labels[labels >= 0], return_inverse=True)
+    n_known = np.bincount(
+        members, weights=is_known[labels >= 0], minlength=len(clusters)
+    )
+    n_polluted = np.bincount(
+        members, weights=(polluted == 1)[labels >= 0], minlength=len(clusters)
+    )
+    return clusters, n_polluted, n_known
+
+
+def cluster_purity(ids, labels):
+    """
+    The purity of each cluster: the fraction of known polluted WDs among its members
+     with a known label (see `cluster_overlap`), NaN if none are.
+    Returns the cluster labels (excluding noise) and their purities.
+    """
+    clusters, n_polluted, n_known = cluster_overlap(ids, labels)
+    with np.errstate(invalid="ignore"):
+        return clusters, n_polluted / n_known
+
+
+def identify_islands(ids, labels):
+    """
+    Finds the clusters of the two polluted islands: those which overlap the most
+     with the known polluted WDs, i.e. have the most known polluted members (see
+     `cluster_overlap`), ties broken by purity. Purity alone would favour small
+     clusters, e.g. one with a single known member which is polluted.
+    Returns a dict of cluster label, {"cool": ..., "warm": ...}, the cool island
+     being the one with the redder median BP-RP.
+    Raises a ValueError if fewer than two clusters have known polluted members.
+    """
+    clusters, n_polluted, n_known = cluster_overlap(ids, labels)
+    if np.count_nonzero(n_polluted) < 2:
+        raise ValueError(
+            f"Only {np.count_nonzero(n_polluted)} clusters have known polluted"
+            " members, so the two polluted islands can't be identified; try another"
+            " eps or min_samples"
+        )
+    with np.errstate(invalid="ignore"):
+        purity = np.nan_to_num(n_polluted / n_known)
+    islands = clusters[np.lexsort((purity, n_polluted))[-2:]]
+
+    mags = gf.lookup(ids, ["BPmag", "RPmag"])
+    BPRP = mags["BPmag"] - mags["RPmag"]
+    cool, warm = sorted(islands, key=lambda i: -np.median(BPRP[labels == i]))
+    return {"cool": int(cool), "warm": int(warm)}
+
+
+def load_clustering(embedding_file=EMBEDDING_FILE, eps=EPS, min_samples=MIN_SAMPLES):
+    """
+    Loads the embedding in `embedding_file` and its (cached) clustering.
+    Returns a dict of:
+    - ids, embedding: as in `embedding_file`
+    - labels: the DBSCAN label of each source, -1 for noise
+    - cool, warm: the labels of the two polluted islands
+    """
+    with np.load(embedding_file) as fl:
+        ids = fl["ids"]
+        embedding = fl["embedding"]
+    labels = cluster_embedding(ids, embedding, eps, min_samples)
+    return {
+        "ids": ids,
+        "embedding": embedding,
+        "labels": labels,
+        **identify_islands(ids, labels),
+    }
+
+
+# --------------------------
+# Cluster hierarchy, for choosing `eps`
+
+
+def build_hierarchy(ids, embedding, min_samples=MIN_SAMPLES, cache_dir=CLUSTERING_DIR):
+    """
+    Fits HDBSCAN to `embedding`, building the single linkage tree which
+     `cut_hierarchy` cuts. Cached (pickled) in `cache_dir`, keyed by a hash of the
+     IDs, embedding and `min_samples`.
+    """
+    key = xs.array_hash(ids, embedding, np.array([min_samples], dtype=float))
+    cache_file = os.path.join(cache_dir, f"hdbscan_{key}.pkl")
+    if os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+
+    print("Building cluster hierarchy...")
+    with pr.stage("hdbscan", rows=len(embedding)):
+        hierarchy = HDBSCAN(min_samples=min_samples, copy=True).fit(embedding)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_file, "wb") as f:
+        pickle.dump(hierarchy, f)
+    return hierarchy
+
+
+def cut_hierarchy(hierarchy, embedding, eps=EPS, borders=True):
+    """
+    The DBSCAN clustering at `eps` (with the `min_samples` of the hierarchy), from
+     cutting the single linkage tree.
+    This gives the core points of each cluster (DBSCAN*); with `borders`, the other
+     points within `eps` of a core point join the cluster of the nearest one, as in
+     DBSCAN. (Clusters of a single core point are left as noise.)
+    Returns the cluster label of each point, -1 for noise.
+    """
+    labels = hierarchy.dbscan_clustering(eps, min_cluster_size=2)
+    if borders:
+        core = np.flatnonzero(labels >= 0)
+        other = np.flatnonzero(labels < 0)
+        distance, nearest = cKDTree(embedding[core]).query(
+            embedding[other], distance_upper_bound=eps * (1 + 1e-9)
+        )
+        is_border = np.isfinite(distance)
+        labels[other[is_border]] = labels[core[nearest[is_border]]]
+    return labels
+
+
+def scan_eps(eps_values, embedding_file=EMBEDDING_FILE, min_samples=MIN_SAMPLES):
+    """
+    Finds the polluted islands at each of `eps_values`, from a single cluster
+     hierarchy of the embedding in `embedding_file`.
+    Returns a list of dicts, one per `eps`, of the label, size and purity of the
+     cool and warm islands, e.g. {"eps": 2, "cool": 4, "cool_size": ..., ...}
+    """
+    with np.load(embedding_file) as fl:
+        ids = fl["ids"]
+        embedding = fl["embedding"]
+    hierarchy = build_hierarchy(ids, embedding, min_samples)
+
+    results = []
+    for eps in eps_values:
+        labels = cut_hierarchy(hierarchy, embedding, eps)
+        islands = identify_islands(ids, labels)
+        clusters, purity = cluster_purity(ids, labels)
+        result = {"eps": eps, "n_clusters": len(clusters)}
+        for name, label in islands.items():
+            result[name] = label
+            result[f"{name}_size"] = int(np.sum(labels == label))
+            result[f"{name}_purity"] = float(purity[clusters == label][0])
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    print("  eps clusters cool size purity warm size purity")
+    for r in scan_eps(np.arange(1, 4.01, 0.25)):
+        print(
+            f"{r['eps']:>5.2f} {r['n_clusters']:>8} {r['cool_size']:>9}"
+            f" {r['cool_purity']:>6.3f} {r['warm_size']:>9} {r['warm_purity']:>6.3f}"
+        )
+    pr.write_report()
@@ -3,51 +3,343 @@ umap_tsne_xp.py
 ===============
 Performs dimensionality reduction on the Gaia XP coefficients.
 Applies both UMAP and tSNE, saving the embeddings to separate npz files.
+Both can share one k-nearest-neighbour graph, built once with an approximate
+nearest-neighbour index and cached on disk (see `knn_graph`).
 """
 
+import os
+
 import numpy as np
-from umap import UMAP
+from scipy.sparse import csr_matrix
+from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors, sort_graph_by_row_values
+from umap import UMAP
 
+import embedding_model as em
 import preprocessors as pp
+import profiling as pr
+import xp_store as xs
+
+KNN_CACHE_DIR = "../data/interim/knn"
+KNN_BACKEND = "nndescent"
+WORKING_MEMORY = 2**28  # Bytes used at once by `knn_blocked`
+# Steps of the preprocessing chain (see `preprocessors.chain`), e.g. add
+# "error_weight" to down-weight noisy coefficients using `xp_err`
+PREPROCESSOR = ["divide_Gflux"]
+
+
+# --------------------------
+# k-nearest-neighbour backends
+# Each returns the indices and (Euclidean) distances of the `n_neighbors` nearest
+# neighbours of every point, including itself, sorted by distance
+
+
+def knn_exact(data, n_neighbors, random_state=None):
+    "Exact kNN, as used internally by sklearn's TSNE"
+    knn = NearestNeighbors(n_neighbors=n_neighbors).fit(data)
+    distances, indices = knn.kneighbors(data)
+    return indices, distances
+
+
+def knn_nndescent(data, n_neighbors, random_state=None):
+    "Approximate kNN by nearest-neighbour descent (PyNNDescent, as used by UMAP)"
+    from pynndescent import NNDescent
+
+    index = NNDescent(data, n_neighbors=n_neighbors, random_state=random_state)
+    return index.neighbor_graph
+
+
+def knn_hnsw(data, n_neighbors, random_state=None):
+    "Approximate kNN with a hierarchical navigable small world graph (hnswlib)"
+    import hnswlib
+
+    index = hnswlib.Index(space="l2", dim=data.shape[1])
+    index.init_index(
+        max_elements=len(data), ef_construction=200, M=16, random_seed=random_state or 0
+    )
+    index.add_items(data)
+    index.set_ef(max(2 * n_neighbors, 50))
+    indices, sq_distances = index.knn_query(data, k=n_neighbors)
+    return indices.astype(np.int64), np.sqrt(sq_distances)
+
+
+def knn_blocked(data, n_neighbors, random_state=None, working_memory=WORKING_MEMORY):
+    """
+    Exact kNN from blocked float32 matrix products: the squared distances from a
+     block of rows to every point are found at once, in `working_memory` bytes
+     (the float32 distances, and the int64 indices `np.argpartition` returns for
+     them), and only the nearest `n_neighbors` of each row kept, so the (N, N)
+     distance matrix is never formed
+    """
+    data = np.asarray(data, dtype=np.float32)
+    data = data - data.mean(axis=0)  # Smaller norms, so less cancellation
+    sq_norms = np.einsum("ij,ij->i", data, data)
+    block_size = max(1, working_memory // (12 * len(data)))  # 4 + 8 bytes per entry
+    indices = np.empty((len(data), n_neighbors), dtype=np.int64)
+    distances = np.empty((len(data), n_neighbors), dtype=np.float32)
+
+    for start in range(0, len(data), block_size):
+        rows = slice(start, start + block_size)
+        sq = data[rows] @ data.T  # In place from here, so no other (B, N) arrays
+        sq *= -2
+        sq += sq_norms
+        sq += sq_norms[rows, None]
+        nearest = np.argpartition(sq, n_neighbors - 1, axis=1)[:, :n_neighbors].copy()
+        del sq  # Freed, as are the full indices, before the next block
+
+        # Recompute the distances directly, for accuracy, and sort them
+        dist = np.linalg.norm(data[rows, None, :] - data[nearest], axis=2)
+        order = np.argsort(dist, axis=1, kind="stable")
+        indices[rows] = np.take_along_axis(nearest, order, axis=1)
+        distances[rows] = np.take_along_axis(dist, order, axis=1)
+    return indices, distances
+
+
+KNN_BACKENDS = {
+    "exact": knn_exact,
+    "nndescent": knn_nndescent,
+    "hnsw": knn_hnsw,
+    "blocked": knn_blocked,
+}
+
+
+@pr.profiled()
+def knn_graph(
+    data, n_neighbors, backend=KNN_BACKEND, cache_dir=KNN_CACHE_DIR, random_state=None
+):
+    """
+    Finds the `n_neighbors` nearest neighbours of every point in `data` (including
+     itself), with one of `KNN_BACKENDS`.
+    The graph is cached in `cache_dir`, keyed by a hash of `data` and the backend,
+     so it is only computed once: later calls with the same or fewer neighbours
+     (e.g. UMAP after tSNE, or reruns) reuse it.
+    Returns:
+    - indices: (N, n_neighbors)
+    - distances: (N, n_neighbors)
+    """
+    cache_file = os.path.join(cache_dir, f"knn_{backend}_{xs.array_hash(data)}.npz")
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as fl:
+            if fl["indices"].shape[1] >= n_neighbors:
+                return fl["indices"][:, :n_neighbors], fl["distances"][:, :n_neighbors]
+
+    print(f"Building {n_neighbors}-NN graph ({backend})...")
+    indices, distances = KNN_BACKENDS[backend](data, n_neighbors, random_state)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(cache_file, indices=indices, distances=distances)
+    return indices, distances
+
+
+def without_self(indices, distances):
+    """
+    Drops each point from its own neighbours, keeping the nearest `k - 1` others
+     (the furthest neighbour is dropped where the point itself wasn't found).
+    """
+    n_points, n_neighbors = indices.shape
+    not_self = indices != np.arange(n_points)[:, None]
+    keep = not_self & (np.cumsum(not_self, axis=1) < n_neighbors)
+    return (
+        indices[keep].reshape(n_points, n_neighbors - 1),
+        distances[keep].reshape(n_points, n_neighbors - 1),
+    )
+
+
+def knn_to_sparse(indices, distances):
+    """
+    Converts a kNN graph to a sparse (N, N) distance matrix, in the form sklearn
+     expects for precomputed neighbours: each point is its own first neighbour
+     (distance 0, stored explicitly), and each row is sorted by distance.
+    """
+    n_points = len(indices)
+    point_ids = np.arange(n_points)
+    indices, distances = without_self(indices, distances)
+    graph = csr_matrix(
+        (
+            np.concatenate([np.zeros(n_points), distances.ravel()]),
+            (
+                np.concatenate([point_ids, np.repeat(point_ids, indices.shape[1])]),
+                np.concatenate([point_ids, indices.ravel()]),
+            ),
+        ),
+        shape=(n_points, n_points),
+    )
+    return sort_graph_by_row_values(graph, warn_when_not_sorted=False)
+
+
+def rescale_init(embedding):
+    """
+    Rescales an initial tSNE embedding to a standard deviation of 1e-4 (along the
+     first axis), as sklearn does for its PCA initialisation
+    """
+    embedding = np.asarray(embedding, dtype=np.float32)
+    return embedding / np.std(embedding[:, 0]) * 1e-4
+
+
+def pca_init(data, n_components=2, random_state=None):
+    "The PCA initialisation of sklearn's TSNE (which it can't do from a kNN graph)"
+    pca = PCA(n_components=n_components, random_state=random_state)
+    return rescale_init(pca.fit_transform(data))
 
 
-def dim_reduce(data, method, **kwargs):
+def opentsne_fit_transform(data, knn=None, **kwargs):
+    """
+    tSNE with openTSNE, whose FFT-interpolated gradients (FIt-SNE) are multithreaded
+     and scale linearly with the number of points.
+    Takes the same `perplexity`, `n_components`, `random_state` and `init` as
+     sklearn's TSNE, and uses all cores unless `n_jobs` is given.
+    If `knn` (indices, distances, including each point itself) is given, the
+     affinities are computed from it rather than from a new kNN search.
+    Other **kwargs are passed to `openTSNE.TSNE`.
+    """
+    from openTSNE import TSNE as OpenTSNE
+    from openTSNE.affinity import PerplexityBasedNN
+    from openTSNE.nearest_neighbors import PrecomputedNeighbors
+
+    kwargs.setdefault("n_jobs", -1)
+    kwargs["initialization"] = kwargs.pop("init", "pca")
+    affinities = None
+    if knn is not None:
+        affinities = PerplexityBasedNN(
+            perplexity=kwargs.get("perplexity", 30),
+            knn_index=PrecomputedNeighbors(*without_self(*knn)),
+            n_jobs=kwargs["n_jobs"],
+            random_state=kwargs.get("random_state"),
+        )
+    embedding = OpenTSNE(negative_gradient_method="fft", **kwargs).fit(
+        data, affinities=affinities
+    )
+    return np.asarray(embedding)
+
+
+def umap_search_index(data, knn, random_state=None):
+    """
+    A PyNNDescent search index over `data`, with as many neighbours as its kNN
+     graph `knn`, which lets a UMAP fitted from a precomputed kNN graph
+     `transform` new data.
+    The index isn't seeded with `knn` (`init_graph`): PyNNDescent then skips the
+     random projection trees, which queries need to start in the right part of the
+     graph (it's disconnected between clusters), and recall drops to ~0.6. Built
+     from scratch, it takes ~2-3x as long (~20 s for 10^5 sources).
+    The search graph and trees are built here (`prepare`), not at the first query.
+    """
+    from pynndescent import NNDescent
+
+    indices, _ = knn
+    index = NNDescent(
+        data,
+        n_neighbors=indices.shape[1],
+        tree_init=True,
+        random_state=random_state,
+    )
+    index.prepare()
+    return index
+
+
+@pr.profiled()
+def fit_umap(data, knn_backend=None, search_index=True, **kwargs):
+    """
+    Fits UMAP to `data`, returning the fitted reducer: its `embedding_` is the
+     embedding of `data`, and its `transform` embeds new data into it.
+    If `knn_backend` is given, the (cached) kNN graph is used, as in `dim_reduce`;
+     `search_index` then builds the search index `transform` needs.
+    **kwargs are passed to UMAP.
+    """
+    if knn_backend is not None:
+        random_state = kwargs.get("random_state")
+        n_neighbors = kwargs.get("n_neighbors", 15)  # UMAP's default
+        knn = knn_graph(data, n_neighbors, knn_backend, random_state=random_state)
+        if search_index:
+            knn = (*knn, umap_search_index(data, knn, random_state))
+        kwargs["precomputed_knn"] = knn
+    return UMAP(**kwargs).fit(data)
+
+
+TSNE_ENGINES = ["sklearn", "opentsne"]
+
+
+@pr.profiled()
+def dim_reduce(
+    data,
+    method,
+    knn_backend=None,
+    engine="sklearn",
+    preprocessor=None,
+    ids=None,
+    xp_err=None,
+    xp_corr=None,
+    **kwargs,
+):
     """
     Perform dimensionality reduction on the input data.
     `method` must be either 'umap' or 'tsne'.
-    `preprocessor` should be a function that preprocesses the raw np array.
+    If `preprocessor` is given, `data` are the raw XP coefficients of the sources
+     `ids`, which are preprocessed first (see `embedding_model.preprocess`): it may
+     be a chain, the names of its steps joined by "+" (e.g.
+     "divide_Gflux+error_weight"), or the name of a function in `preprocessors.py`.
+     Error weighting also needs the errors `xp_err` (and maybe `xp_corr`) of `data`.
+     Otherwise, `data` should already be preprocessed.
+    If `knn_backend` is given (one of `KNN_BACKENDS`), the nearest neighbours are
+     found with that backend and cached (see `knn_graph`), and passed to UMAP as a
+     precomputed kNN, or to tSNE as a sparse precomputed distance matrix.
+    `engine` selects the tSNE implementation (one of `TSNE_ENGINES`): sklearn's
+     Barnes-Hut TSNE, or the multithreaded FFT-accelerated openTSNE, which is much
+     faster for >10^5 points (see `opentsne_fit_transform`).
     **kwargs are passed to the respective dimensionality reduction method.
     """
     assert method in ["umap", "tsne"], 'Invalid method; must be "umap" or "tsne".'
+    assert engine in TSNE_ENGINES, f"Invalid engine; must be one of {TSNE_ENGINES}."
+    if preprocessor is not None:
+        data = em.preprocess(data, ids, preprocessor, xp_err, xp_corr)
 
     if method == "umap":
-        reducer = UMAP(**kwargs)
-    else:  # method == "tsne"
-        reducer = TSNE(**kwargs)
+        return fit_umap(data, knn_backend, search_index=False, **kwargs).embedding_
 
-    return reducer.fit_transform(data)
+    knn = None
+    if knn_backend is not None:
+        random_state = kwargs.get("random_state")
+        # As in sklearn's TSNE, with its default perplexity
+        n_neighbors = min(len(data) - 1, int(3 * kwargs.get("perplexity", 30) + 1))
+        knn = knn_graph(data, n_neighbors + 1, knn_backend, random_state=random_state)
+
+    if engine == "opentsne":
+        return opentsne_fit_transform(data, knn, **kwargs)
+    if knn is not None:
+        if kwargs.get("init", "pca") == "pca":
+            kwargs["init"] = pca_init(data, kwargs.get("n_components", 2), random_state)
+        kwargs["metric"] = "precomputed"
+        data = knn_to_sparse(*knn)
+    return TSNE(**kwargs).fit_transform(data)
 
 
 if __name__ == "__main__":
 
     print("Loading data...")
-    fl = np.load("../data/interim/xp_coeffs.npz")
+    fl = xs.load_store("../data/interim/xp_coeffs")
     ids = fl["ids"]
-    xp = fl["xp"]
-    pxp = pp.divide_Gflux(xp, ids)  # Normalise by G-band flux
+    # Preprocess chunk by chunk from the store, into a single array
+    preprocessor, pxp = pp.fit_transform(
+        pp.chain(*PREPROCESSOR),
+        fl["xp"],
+        ids,
+        xp_err=fl["xp_err"],
+        xp_corr=fl.get("xp_corr"),
+    )
 
     print("Performing dimensionality reduction...")
-    print("UMAP...")
-    umap_embedding = dim_reduce(pxp, "umap", n_neighbors=25, min_dist=0.05)  # ~45s
+    # tSNE first, as it needs the most neighbours; UMAP then reuses its kNN graph
+    print("tSNE...")
+    tsne_embedding = dim_reduce(pxp, "tsne", knn_backend=KNN_BACKEND, perplexity=50)
     print("Saving...")
     np.savez_compressed(
-        "../data/processed/umap_xp.npz", ids=ids, embedding=umap_embedding
+        "../data/processed/tsne_xp.npz", ids=ids, embedding=tsne_embedding
     )
 
-    print("tSNE...")
-    tsne_embedding = dim_reduce(pxp, "tsne", perplexity=50)  # ~4m
+    print("UMAP...")
+    reducer = fit_umap(pxp, knn_backend=KNN_BACKEND, n_neighbors=25, min_dist=0.05)
     print("Saving...")
     np.savez_compressed(
-        "../data/processed/tsne_xp.npz", ids=ids, embedding=tsne_embedding
+        "../data/processed/umap_xp.npz", ids=ids, embedding=reducer.embedding_
     )
+    em.save_umap_model(reducer, preprocessor=preprocessor)
+    pr.write_report()
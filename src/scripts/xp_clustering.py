@@ -0,0 +1,90 @@
+"""
+xp_clustering.py
+================
+Finds polluted WD candidates directly in the 110-D space of the G-flux-normalised
+XP coefficients, without tSNE.
+The exact k-nearest neighbours of every source are found with blocked float32
+distance computations (`umap_tsne_xp.knn_blocked`), so memory doesn't grow as N^2,
+and cached as in `umap_tsne_xp.knn_graph`. From these:
+- each source is scored by the fraction of its labelled neighbours which are known
+  to be polluted (see `check_polluted.py`), and
+- the sources are clustered with DBSCAN on the kNN graph, with `eps` set from the
+  distribution of distances to the `MIN_SAMPLES`-th neighbour, and the purity of
+  each cluster reported, as for the tSNE islands (see `tsne_clustering.py`).
+Saves the scores and cluster labels to `data/processed/xp_clusters.npz`.
+"""
+
+import numpy as np
+from sklearn.cluster import DBSCAN
+
+import check_polluted as cp
+import preprocessors as pp
+import profiling as pr
+import tsne_clustering as tc
+import umap_tsne_xp as ut
+import xp_store as xs
+
+XP_COEFFS_STORE = "../data/interim/xp_coeffs"
+N_NEIGHBORS = 60  # Including the source itself
+MIN_SAMPLES = 30
+EPS_QUANTILE = 0.5  # Fraction of sources which are core points
+
+
+def load_data(store_path=XP_COEFFS_STORE):
+    "The IDs and G-flux-normalised XP coefficients (float32) of the sample"
+    store = xs.load_store(store_path)
+    ids = np.asarray(store["ids"])
+    chain = pp.chain("divide_Gflux", dtype=np.float32)  # As the kNN search uses
+    return ids, pp.transform(chain, store["xp"], ids)
+
+
+def polluted_score(ids, indices):
+    """
+    The fraction of each source's neighbours `indices` (excluding itself) with a
+     known label which are polluted, NaN if none have a known label
+    """
+    polluted = cp.is_polluted_many(ids)[indices[:, 1:]]
+    with np.errstate(invalid="ignore"):
+        return np.sum(polluted == 1, axis=1) / np.sum(polluted >= 0, axis=1)
+
+
+@pr.profiled("dbscan_knn")
+def cluster_knn(indices, distances, min_samples=MIN_SAMPLES, eps=None):
+    """
+    DBSCAN on the kNN graph: `eps` neighbourhoods only include the sources in each
+     other's kNN, so core points are exact, but clusters may split where they're
+     only joined by longer edges.
+    `eps` defaults to the `EPS_QUANTILE` quantile of the distances to the
+     `min_samples`-th neighbour (counting the source itself, as DBSCAN does).
+    Returns the cluster label of each source, -1 for noise, and `eps`.
+    """
+    if eps is None:
+        eps = float(np.quantile(distances[:, min_samples - 1], EPS_QUANTILE))
+    dbscan = DBSCAN(eps=eps, min_samples=min_samples, metric="precomputed")
+    return dbscan.fit(ut.knn_to_sparse(indices, distances)).labels_, eps
+
+
+if __name__ == "__main__":
+    print("Loading data...")
+    ids, pxp = load_data()
+    indices, distances = ut.knn_graph(pxp, N_NEIGHBORS, "blocked")
+
+    print("Scoring and clustering...")
+    score = polluted_score(ids, indices)
+    labels, eps = cluster_knn(indices, distances)
+
+    clusters, purity = tc.cluster_purity(ids, labels)
+    sizes = np.bincount(labels[labels >= 0])
+    print(f"{len(clusters)} clusters at eps={eps:.3g}, by purity:")
+    for i in np.argsort(-np.nan_to_num(purity))[:10]:
+        size = sizes[clusters[i]]
+        print(f"  cluster {clusters[i]:>4}: {size:>6} sources, purity {purity[i]:.3f}")
+
+    np.savez_compressed(
+        "../data/processed/xp_clusters.npz",
+        ids=ids,
+        score=score,
+        labels=labels,
+        eps=eps,
+    )
+    pr.write_report()
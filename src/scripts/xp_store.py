@@ -0,0 +1,123 @@
+"""
+xp_store.py
+===========
+A simple memory-mappable store for the interim data products (`xp_coeffs`,
+`xp_sampled`), replacing `np.savez_compressed`.
+A store is a directory containing one uncompressed .npy file per array, e.g.
+`data/interim/xp_coeffs/{ids,xp,xp_err,xp_corr}.npy`, plus `ids_order.npy`, the
+argsort of `ids`, so rows can be selected by Gaia ID without reading everything.
+Opening a store only reads the .npy headers; rows are paged in from disk as they
+are used, so load time and resident memory don't grow with the number of sources.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+INTERIM_DIR = "../data/interim"
+
+
+def save_store(path, **arrays):
+    """
+    Saves the given arrays to the store at `path`, one .npy file each.
+    If `ids` is given, also saves `ids_order`, so that rows can be looked up by ID.
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+    if "ids" in arrays:
+        index_store(path)
+
+
+def index_store(path):
+    "(Re)builds `ids_order.npy` for the store at `path`"
+    ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+    np.save(os.path.join(path, "ids_order.npy"), np.argsort(ids, kind="stable"))
+
+
+def load_store(path, mmap_mode="r"):
+    """
+    Opens the store at `path`, returning a dict of memory-mapped arrays.
+    Falls back to a legacy `path.npz` file (fully decompressed) if there's no store.
+    """
+    if not os.path.isdir(path) and os.path.exists(f"{path}.npz"):
+        with np.load(f"{path}.npz") as fl:
+            return dict(fl)
+    return {
+        fname[: -len(".npy")]: np.load(os.path.join(path, fname), mmap_mode=mmap_mode)
+        for fname in sorted(os.listdir(path))
+        if fname.endswith(".npy")
+    }
+
+
+def find_rows(store, ids):
+    """
+    Finds the rows of `store` containing the Gaia IDs `ids`, in the same order.
+    IDs which aren't in the store get row -1.
+    """
+    store_ids = store["ids"]
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(store_ids) == 0:
+        return np.full(len(ids), -1)
+    order = store["ids_order"] if "ids_order" in store else np.argsort(store_ids)
+
+    sorted_ids = store_ids[order]
+    pos = np.searchsorted(sorted_ids, ids).clip(max=len(sorted_ids) - 1)
+    found = sorted_ids[pos] == ids
+    return np.where(found, order[pos], -1)
+
+
+def select_rows(store, ids):
+    """
+    Finds the rows of `store` containing the Gaia IDs `ids`, in the same order.
+    Raises a KeyError if any of the IDs isn't in the store.
+    """
+    rows = find_rows(store, ids)
+    if np.any(rows < 0):
+        missing = np.asarray(ids)[rows < 0]
+        raise KeyError(f"{len(missing)} IDs not in store, e.g. {missing[0]}")
+    return rows
+
+
+def load_rows(path, ids, names=None):
+    """
+    Loads the rows of the store at `path` for the Gaia IDs `ids`, in the same order.
+    Only the rows needed are read from disk.
+    `names` selects which arrays to load (default: all with one row per source).
+    """
+    store = load_store(path)
+    rows = select_rows(store, ids)
+    if names is None:
+        n_sources = len(store["ids"])
+        names = [
+            name
+            for name, array in store.items()
+            if name != "ids_order" and array.ndim > 0 and len(array) == n_sources
+        ]
+    return {name: np.asarray(store[name][rows]) for name in names}
+
+
+def array_hash(*arrays):
+    "Content hash of some arrays (e.g. to key cached results computed from them)"
+    sha = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        sha.update(f"{array.dtype}{array.shape}".encode())
+        sha.update(array.data)
+    return sha.hexdigest()[:16]
+
+
+def convert_npz(npz_path, path):
+    "Converts a legacy .npz file to a store"
+    with np.load(npz_path) as fl:
+        save_store(path, **fl)
+
+
+if __name__ == "__main__":
+    # Converts existing interim .npz files to stores
+    for name in ["xp_coeffs", "xp_sampled"]:
+        npz_path = os.path.join(INTERIM_DIR, f"{name}.npz")
+        if os.path.exists(npz_path):
+            print(f"Converting {npz_path}...")
+            convert_npz(npz_path, os.path.join(INTERIM_DIR, name))